@@ -1,86 +1,61 @@
 # Imports
 import os
-import geopandas as gpd
-import pandas as pd
-from shapely.geometry import Polygon
-import re
+import argparse
+import multiprocessing
+import multiprocessing.util
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 # Helpers
 import convert_and_load_data
 import calculate_weighted_sums
 import calculate_weighted_averages
-
-#region Create geometry for each coordinate pair. Works with any spatial resolution (degree = coordinate spacing)
-def create_geometry(data, lon_column, lat_column, degree):
-
-    # Calculate corner-points of the grid cell from the center coordinate pair
-    data['geometry'] = [
-        Polygon([(lon - degree / 2, lat - degree / 2), (lon - degree / 2, lat + degree / 2),
-                 (lon + degree / 2, lat + degree / 2), (lon + degree / 2, lat - degree / 2)])
-        for lon, lat in zip(data[lon_column], data[lat_column])
-    ]
-    return data
+import weight_cache
+import sparse_aggregation
+import grid_cell_weights
+import output_writer
+import streaming_aggregation
+import instrumentation
+import incremental_aggregation
+import weighted_statistics
+import cell_weighting
+import command_line
+import nuts_layer
+
+#region Load NUTS-areas once per shapefile
+# Loaded shapefiles are kept in 'nuts_areas_by_path', so each shapefile is read at most once per run.
+# Only the NUTS_ID and the geometry are read, a preprocessed copy is cached in 'nuts_cache_dir'
+def load_nuts_areas(shapefile_path, nuts_areas_by_path, simplify='none', max_area_error=0.01, nuts_cache_dir=None):
+
+    if shapefile_path not in nuts_areas_by_path:
+        with instrumentation.stage('load_shapefile', shapefile=shapefile_path) as record:
+            nuts_areas_by_path[shapefile_path] = nuts_layer.load_nuts_layer(
+                shapefile_path, simplify=simplify, max_area_error=max_area_error, cache_dir=nuts_cache_dir)
+            record['rows_out'] = len(nuts_areas_by_path[shapefile_path])
+    return nuts_areas_by_path[shapefile_path]
 #endregion
 
-#region calculate_grid_cell_and_intersected_area
-def calculate_grid_cell_and_intersected_area(forest_data, nuts_areas):
-
-    # Add geometry column of gridd cells to forest_data (0.5-degree resolution cell grid)
-    forest_data = create_geometry(forest_data, 'Lon', 'Lat', degree=0.5)
-
-    # Create the GeoDataFrame with CRS EPSG:4326
-    grid_cells = gpd.GeoDataFrame(forest_data, geometry=forest_data["geometry"], crs="EPSG:4326")
-    
-    # Update the EPSG to meters
-    grid_cells = grid_cells.to_crs("EPSG:3035")
-    
-    # Calculating the grid cell areas in km2
-    grid_cells['area_km2'] = pd.to_numeric(grid_cells.geometry.area / 1000000, errors='coerce')
-
-    # Set the same EPSG for NUTS-areas
-    nuts_areas = nuts_areas.to_crs("EPSG:3035")
-    
-    # Spatial intersections of grid cells and nuts_areas - the overlapping area of grid cells with NUTS-areas
-    intersections = gpd.overlay(grid_cells, nuts_areas, how='intersection')
-
-    # Calculate the intersected area for each grid cell
-    intersections['intersection_area_km2'] = pd.to_numeric(intersections['geometry'].area / 1000000, errors='coerce')
-
-    # Ensure 'intersection_weight' is numeric
-    intersections['intersection_weight'] = intersections.apply(
-        lambda row: pd.to_numeric(row['intersection_area_km2'] / row['area_km2'], errors='coerce'), axis=1
-    )
-
-    # Check that all intersection weights are between 0 and 1
-    tolerance = 1e-10
-    if not all(0 - tolerance <= w <= 1 + tolerance for w in intersections['intersection_weight']):
-        raise ValueError("Some weights are outside the expected range of [0, 1].")
-
-    # Print progress
-    print("5: Grid cells created and intersected areas calculated for grid cells")
-
-    # Load the NUTS region surface area data csv's
-    #nuts_surface_area_df = pd.read_csv("../input_data/filtered_nuts2_surface_areas_landuse_total.csv", sep=';')
-    
-    # Keep only relevant columns
-    #nuts_surface_area_df = nuts_surface_area_df[['NUTS_ID', 'official_surface_area_2021']]
-    
-    # Merge with the intersections GeoDataFrame on NUTS_ID
-    #intersections = intersections.merge(nuts_surface_area_df, on='NUTS_ID', how='left')
-
-    return intersections
-#endregion
-
-#region Save results
-def save_results(weighted_avg_df, output_path, output_path_semicolon):
-
-    # Save the data to CSV
-    weighted_avg_df.to_csv(output_path, index=False)
-    print(f"** Weighted averages saved to {output_path}, AND...  **")
-
-    # Save the data to a semicolon-separated file with commas as decimal points (easily workable in excel)
-    weighted_avg_df.to_csv(output_path_semicolon, index=False, sep=";", decimal=",")
-    print(f"** ...weighted averages saved to {output_path_semicolon} **")
+#region Load cached cell weights or calculate them
+# The shapefile is only read when there is no valid cached weight table for the grid and shapefile.
+# In pipelined mode, 'shapefile_future' is the shapefile being loaded in an I/O thread, which is waited for instead
+def load_or_calculate_cell_weights(forest_data, shapefile_path, degree, area_method, overlay_method, overlay_workers, cache_dir, cache_max_size_mb, nuts_areas_by_path,
+                                   simplify='none', max_area_error=0.01, nuts_cache_dir=None, shapefile_future=None):
+
+    cells = forest_data[['Lon', 'Lat']].drop_duplicates()
+    with instrumentation.stage('cell_weights', rows_in=len(cells), shapefile=shapefile_path) as record:
+        cache_key = weight_cache.weights_cache_key(cells, degree, shapefile_path, area_method, simplify, max_area_error)
+
+        cell_weights = weight_cache.load_cell_weights(cache_key, cache_dir)
+        record['cache_hit'] = cell_weights is not None
+        if cell_weights is None:
+            if shapefile_future is not None:
+                nuts_areas = shapefile_future.result()
+            else:
+                nuts_areas = load_nuts_areas(shapefile_path, nuts_areas_by_path, simplify, max_area_error, nuts_cache_dir)
+            cell_weights = grid_cell_weights.calculate_cell_weights(forest_data, nuts_areas, degree=degree, area_method=area_method,
+                                                                    overlay_method=overlay_method, overlay_workers=overlay_workers)
+            weight_cache.save_cell_weights(cell_weights, cache_key, cache_dir, cache_max_size_mb)
+        record['rows_out'] = len(cell_weights)
+    return cell_weights
 #endregion
 
 #region Extract variable names from input file
@@ -92,63 +67,425 @@ def extract_variables(forest_data):
 
 #region Input and output data paths
 
-# Shapefile for NUTS-areas
-shapefile_path = '../input_data/nuts_data/NUTS_RG_01M_2021_3035_LEVL_2.shp'
+# Shapefile for NUTS-areas, e.g. NUTS_RG_01M_2021_3035_LEVL_2.shp
+def nuts_shapefile_path(nuts_dir, nuts_scale, nuts_year, level):
+    return os.path.join(nuts_dir, f"NUTS_RG_{nuts_scale}_{nuts_year}_3035_LEVL_{level}.shp")
+
+# Output paths of the NUTS-area and country results of one NUTS level
+def output_paths(output_dir, input_file_name, nuts_year_scale, level):
+
+    return command_line.output_paths(output_dir, input_file_name, nuts_year_scale, {
+        'nuts_avg': ('nuts_weighted_averages_', f'NUTS_{level}', 'avg'),
+        'country_avg': ('country_weighted_avgs_', 'country', 'avg'),
+        'nuts_sum': ('nuts_weighted_sums_', f'NUTS_{level}', 'sum'),
+        'country_sum': ('country_weighted_sums_', 'country', 'sum'),
+        'nuts_stats': ('nuts_weighted_statistics_', f'NUTS_{level}', 'statistics'),
+        'country_stats': ('country_weighted_statistics_', 'country', 'statistics'),
+    })
+#endregion
 
-# Define input file prefix
-INPUT_FILE_NAME = 'cpool'
+#region Command line arguments
+def parse_arguments(argv=None):
+
+    parser = argparse.ArgumentParser(description="Calculate weighted averages and sums of LPJ-GUESS variables for NUTS-areas and countries.")
+    command_line.add_input_arguments(parser)
+    parser.add_argument('--levels', nargs='+', type=int, default=None, choices=[0, 1, 2, 3],
+                        help="NUTS levels to aggregate to (default: 2, with --hierarchy: 0 1 2 3)")
+    parser.add_argument('--hierarchy', action='store_true',
+                        help="Overlay only against the NUTS-3 shapefile and roll the results up to the other NUTS levels")
+    parser.add_argument('--nuts-dir', default='../input_data/nuts_data/', help="Directory of the NUTS shapefiles (default: %(default)s)")
+    parser.add_argument('--nuts-scale', default='01M', help="Scale of the NUTS shapefiles: 01M, 03M, 10M, 20M or 60M (default: %(default)s)")
+    parser.add_argument('--nuts-year', default='2021', help="Year of the NUTS shapefiles (default: %(default)s)")
+    command_line.add_weight_arguments(parser, weighting='fraction')
+    command_line.add_output_arguments(parser)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument('--nuts-cache-dir', default='../output/nuts_cache/',
+                        help="Cache directory for the preprocessed NUTS layers (GeoParquet) (default: %(default)s)")
+    parser.add_argument('--simplify', choices=list(nuts_layer.SIMPLIFICATION_TIERS), default='none',
+                        help="Simplify the NUTS-areas for fast exploratory runs: fine (250 m), medium (1 km) or coarse (5 km) (default: %(default)s)")
+    parser.add_argument('--simplify-max-area-error', type=float, default=0.01,
+                        help="Largest relative area change of a NUTS-area from the simplification (default: %(default)s)")
+    parser.add_argument('--export-csv', action='store_true', help="Also save the LPJ-GUESS data as csv in <output-dir>/lpj-guess_csv/")
+    parser.add_argument('--streaming', action='store_true',
+                        help="Read and weight the .out files in chunks with fixed-size per-(region, year) accumulators")
+    parser.add_argument('--groupby', action='store_true', help="Use the per-variable groupby aggregation instead of the sparse matrix engine")
+    parser.add_argument('--statistics', nargs='+', choices=weighted_statistics.STATISTICS, default=None,
+                        help="Also save these statistics in one table per NUTS level and country, calculated in the same pass as the sums and averages")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Aggregate only the years that are new or changed since the previous run and merge them into the existing outputs")
+    parser.add_argument('--pipelined', action='store_true',
+                        help="Overlap reading, aggregation and writing: concurrent loading, a bounded job queue and background output writes")
+    parser.add_argument('--io-threads', type=int, default=4, help="Threads for concurrent reading in --pipelined mode (default: %(default)s)")
+    parser.add_argument('--queue-size', type=int, default=None,
+                        help="Maximum number of queued or running jobs in --pipelined mode (default: 2 x workers)")
+    parser.add_argument('--report', default=None,
+                        help="Save a JSON run report with the wall time, peak RSS and row counts of each stage to this path")
+    parser.add_argument('--profile-stage', choices=instrumentation.STAGES, default=None,
+                        help="Profile every run of one stage, the cProfile files are saved in <output-dir>/profiles/")
+    parser.add_argument('--profile-method', choices=instrumentation.PROFILE_METHODS, default='cprofile',
+                        help="cProfile statistics or tracemalloc allocations of the profiled stage (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    if args.levels is None:
+        args.levels = [0, 1, 2, 3] if args.hierarchy else [2]
+    if args.incremental and (args.streaming or args.groupby):
+        parser.error("--incremental uses the sparse matrix engine and cannot be combined with --streaming or --groupby")
+    if args.statistics and (args.streaming or args.groupby or args.incremental):
+        parser.error("--statistics uses the sparse matrix engine and cannot be combined with --streaming, --groupby or --incremental")
+    return args
+#endregion
 
-NUTS_YEAR_SCALE = f"{re.search(r'NUTS_RG_(\d+M)_(\d{4})', shapefile_path).groups()[1]}_{re.search(r'NUTS_RG_(\d+M)_(\d{4})', shapefile_path).groups()[0]}"
+#region NUTS levels of the overlays
+# Returns (overlay level, output levels) pairs. In hierarchy mode, all levels come from one NUTS-3 overlay
+def overlay_levels(args):
 
-# File extensions for .out and .csv
-forest_data_path_out = '../input_data/lpj-guess_out/' + INPUT_FILE_NAME + '.out'
-forest_data_path_csv = '../output/lpj-guess_csv/' + INPUT_FILE_NAME + '_' + NUTS_YEAR_SCALE + '.csv'
+    if args.hierarchy:
+        return [(3, sorted(set(args.levels)))]
+    return [(level, [level]) for level in args.levels]
+#endregion
 
-# Define output file paths - *Note: "semicolon" paths are for easy access in excel* 
-output_path_nuts_avg = '../output/csv/nuts_weighted_averages_' + INPUT_FILE_NAME + '_' + NUTS_YEAR_SCALE + '.csv'
-output_path_semicolon_nuts_avg = '../output/excel/nuts_weighted_averages_' + INPUT_FILE_NAME + '_' + NUTS_YEAR_SCALE  + '_excel.csv'
+#region Save results of all NUTS levels and countries
+def save_results_by_level(results, levels, paths_by_level, country_paths, output_formats, statistics_results=None, save_results=output_writer.save_results):
+
+    # Save NUTS-area level results
+    for level in levels:
+        weighted_sum_df, weighted_avg_df_nuts = results[level]
+        save_results(weighted_avg_df_nuts, paths_by_level[level]['nuts_avg'], output_formats)
+        save_results(weighted_sum_df, paths_by_level[level]['nuts_sum'], output_formats)
+
+    # Save country level results
+    weighted_sum_df, weighted_avg_df_country = results['Country']
+    save_results(weighted_avg_df_country, country_paths['country_avg'], output_formats)
+    save_results(weighted_sum_df, country_paths['country_sum'], output_formats)
+
+    # Save the tables of all statistics
+    if statistics_results is not None:
+        for level in levels:
+            save_results(statistics_results[level], paths_by_level[level]['nuts_stats'], output_formats)
+        save_results(statistics_results['Country'], country_paths['country_stats'], output_formats)
+#endregion
 
-output_path_country_avg = '../output/csv/country_weighted_avgs_' + INPUT_FILE_NAME + '_' + NUTS_YEAR_SCALE + '.csv'
-output_path_semicolon_country_avg = '../output/excel/country_weighted_avgs_' + INPUT_FILE_NAME + '_' + NUTS_YEAR_SCALE  + '_excel.csv'
+#region Aggregate one .out file
+# Runs in a worker process, the cell weights are calculated once per grid and NUTS level in the main process.
+# 'levels' are the NUTS levels to write, the cell weights can be for the same or a finer NUTS level
+def aggregate_file(forest_data_path_out, cell_weights, levels, paths_by_level, country_paths, export_csv_path, args):
 
-output_path_sum = '../output/csv/nuts_weighted_sums_' + INPUT_FILE_NAME + '_' + NUTS_YEAR_SCALE + '.csv'
-output_path_semicolon_sum = '../output/excel/nuts_weighted_sums_' + INPUT_FILE_NAME + '_' + NUTS_YEAR_SCALE  + '_excel.csv'
+    # Worker processes record their stages and return the records with the result
+    instrumentation.configure(profile_stage=args.profile_stage, profile_method=args.profile_method,
+                              profile_dir=os.path.join(args.output_dir, 'profiles'))
 
-output_path_country_sum = '../output/csv/country_weighted_sums_' + INPUT_FILE_NAME + '_' + NUTS_YEAR_SCALE + '.csv'
-output_path_semicolon_country_sum = '../output/excel/country_weighted_sums_' + INPUT_FILE_NAME + '_' + NUTS_YEAR_SCALE  + '_excel.csv'
+    aggregate_and_save(forest_data_path_out, lambda: cell_weights, levels, paths_by_level, country_paths, export_csv_path, args, output_writer.save_results)
+    return forest_data_path_out, instrumentation.take_records()
 #endregion
 
-def main():
-    if not os.path.exists(forest_data_path_out) or not os.path.exists(shapefile_path):
-        print("Input files not found. Check the file paths.")
+#region Pipelined worker processes
+# State of a pipelined worker process: one background writer for all its jobs, so the outputs of one file are written
+# while the next file is parsed and aggregated. The cell weights are published by the main process in 'shared_weights'
+pipeline_worker = {'writer': None, 'shared_weights': None, 'condition': None, 'results': None, 'cell_weights': (None, None)}
+
+# Process pool initializer. The writer is flushed when the worker process exits
+def start_pipeline_worker(shared_weights, condition, results):
+
+    pipeline_worker.update(writer=output_writer.BackgroundWriter(), shared_weights=shared_weights, condition=condition, results=results)
+    multiprocessing.util.Finalize(None, stop_pipeline_worker, exitpriority=10)
+
+# Waits for the last outputs and sends the records of the writes after the last job, and the first write error, to the main process
+def stop_pipeline_worker():
+
+    error = None
+    try:
+        pipeline_worker['writer'].close()
+    except Exception as write_error:
+        error = write_error
+    pipeline_worker['results'].put((instrumentation.take_records(), error))
+
+# Waits until the main process has published the cell weights of the grid, the last ones are kept for the next job
+def published_cell_weights(grid_key):
+
+    if pipeline_worker['cell_weights'][0] != grid_key:
+        with pipeline_worker['condition']:
+            pipeline_worker['condition'].wait_for(lambda: grid_key in pipeline_worker['shared_weights'])
+        pipeline_worker['cell_weights'] = (grid_key, pipeline_worker['shared_weights'][grid_key])
+
+    # The weights could not be calculated
+    cell_weights = pipeline_worker['cell_weights'][1]
+    if isinstance(cell_weights, Exception):
+        raise cell_weights
+    return cell_weights
+
+# The job has the key of the cell weights, which are waited for only after the .out file is parsed.
+# The outputs are queued to the writer of the worker, a write error is raised by a later job of the worker or at shutdown
+def aggregate_file_pipelined(forest_data_path_out, grid_key, levels, paths_by_level, country_paths, export_csv_path, args):
+
+    instrumentation.configure(profile_stage=args.profile_stage, profile_method=args.profile_method,
+                              profile_dir=os.path.join(args.output_dir, 'profiles'))
+
+    aggregate_and_save(forest_data_path_out, lambda: published_cell_weights(grid_key), levels, paths_by_level, country_paths, export_csv_path, args,
+                       pipeline_worker['writer'].save_results)
+    return forest_data_path_out, instrumentation.take_records()
+#endregion
+
+#region Aggregate one .out file and save the results
+# 'get_cell_weights' returns the cell weights, in pipelined mode they are waited for only after the .out file is parsed.
+# 'save_results' saves one result table, output_writer.save_results or a background writer
+def aggregate_and_save(forest_data_path_out, get_cell_weights, levels, paths_by_level, country_paths, export_csv_path, args, save_results):
+
+    if export_csv_path is not None:
+        convert_and_load_data.convert_out_file_to_csv(forest_data_path_out, export_csv_path)
+
+    variable_dtype = 'float32' if args.float32 else 'float64'
+
+    if args.streaming:
+        # Read and weight the .out file in chunks, the whole file is never in memory
+        cell_weights = get_cell_weights()
+        with instrumentation.stage('aggregate', file=forest_data_path_out, engine='streaming') as record:
+            nuts_totals = streaming_aggregation.calculate_weighted_totals_streaming(forest_data_path_out, cell_weights, args.max_memory_mb, variable_dtype)
+
+            # Roll the NUTS-area totals up to each NUTS level and country
+            results = sparse_aggregation.weighted_totals_to_frames_by_level(nuts_totals, levels)
+            record['rows_in'] = nuts_totals['input_rows']
+            record['rows_out'] = sum(len(weighted_df) for result in results.values() for weighted_df in result)
+        save_results_by_level(results, levels, paths_by_level, country_paths, args.output_formats, save_results=save_results)
         return
-    
-    convert_and_load_data.convert_out_file_to_csv(forest_data_path_out, forest_data_path_csv)
 
-    nuts_areas = convert_and_load_data.load_data_shp(shapefile_path)
-    forest_data = convert_and_load_data.load_data_csv(forest_data_path_csv)
+    with instrumentation.stage('parse', file=forest_data_path_out) as record:
+        forest_data = convert_and_load_data.load_data_out(forest_data_path_out, variable_dtype)
+        record['rows_out'] = len(forest_data)
 
     # Extract the variables from the LPJ-GUESS input file
     variables_to_include = extract_variables(forest_data)
+    cell_weights = get_cell_weights()
+
+    if args.incremental:
+        # Only the new or changed years are aggregated and merged into the existing outputs, one manifest per input and overlay
+        overlay_level = 3 if args.hierarchy else levels[0]
+        name = os.path.splitext(os.path.basename(forest_data_path_out))[0] + f"_{args.nuts_year}_{args.nuts_scale}_LEVL_{overlay_level}"
+        incremental_aggregation.aggregate_incremental(
+            forest_data, variables_to_include, cell_weights, levels, paths_by_level, country_paths, args.output_formats,
+            incremental_aggregation.manifest_path(args.output_dir, name), {'levels': list(levels), 'float32': args.float32})
+    elif not args.groupby:
+        with instrumentation.stage('aggregate', rows_in=len(forest_data), file=forest_data_path_out, engine='sparse') as record:
+            # Data as a dense (cells x years*variables) matrix, shared by all groupings
+            # var/std and min/max skip missing values, which need the value mask
+            value_mask = bool(args.statistics) and any(statistic in args.statistics for statistic in ['var', 'std', 'min', 'max'])
+            data_matrix = sparse_aggregation.build_data_matrix(forest_data, variables_to_include, value_mask)
+
+            # Calculate weighted sums and averages for each NUTS level and country in one pass
+            statistics_results = None
+            if args.statistics:
+                # The sums and averages come from the same accumulators as the other statistics
+                nuts_totals = weighted_statistics.calculate_statistic_totals(cell_weights, data_matrix, args.statistics)
+                statistics_results = weighted_statistics.statistic_totals_to_frames_by_level(nuts_totals, levels, args.statistics)
+                results = sparse_aggregation.weighted_totals_to_frames_by_level(nuts_totals, levels)
+            else:
+                results = sparse_aggregation.calculate_weighted_sums_and_averages_by_level(cell_weights, data_matrix, levels)
+            record['rows_out'] = sum(len(weighted_df) for result in results.values() for weighted_df in result)
+        save_results_by_level(results, levels, paths_by_level, country_paths, args.output_formats, statistics_results, save_results)
+    else:
+        with instrumentation.stage('aggregate', rows_in=len(forest_data), file=forest_data_path_out, engine='groupby', result='join') as record:
+            intersections = grid_cell_weights.join_cell_weights(cell_weights, forest_data)
+            record['rows_out'] = len(intersections)
+        
+        for level in levels:
+            # NUTS-area codes of the level, e.g. NUTS-3 'FI1B1' -> NUTS-2 'FI1B'
+            intersections_level = intersections.assign(NUTS_ID=intersections['NUTS_ID'].str[:2 + level])
+
+            # Calculate weighted averages: NUTS-area level
+            with instrumentation.stage('aggregate', rows_in=len(intersections), file=forest_data_path_out, engine='groupby', result=f'nuts_avg_{level}') as record:
+                weighted_avg_df_nuts = calculate_weighted_averages.calculate_weighted_averages_nuts_level(intersections_level, variables_to_include)
+                record['rows_out'] = len(weighted_avg_df_nuts)
+            save_results(weighted_avg_df_nuts, paths_by_level[level]['nuts_avg'], args.output_formats)
+
+            # Calculate weighted sums: NUTS-area level
+            with instrumentation.stage('aggregate', rows_in=len(intersections), file=forest_data_path_out, engine='groupby', result=f'nuts_sum_{level}') as record:
+                weighted_sum_df = calculate_weighted_sums.calculate_weighted_sums_nuts_level(intersections_level, variables_to_include)
+                record['rows_out'] = len(weighted_sum_df)
+            save_results(weighted_sum_df, paths_by_level[level]['nuts_sum'], args.output_formats)
+
+        # Calculate weighted averages: Country level
+        with instrumentation.stage('aggregate', rows_in=len(intersections), file=forest_data_path_out, engine='groupby', result='country_avg') as record:
+            weighted_avg_df_country = calculate_weighted_averages.calculate_weighted_averages_country_level(intersections, variables_to_include)
+            record['rows_out'] = len(weighted_avg_df_country)
+        save_results(weighted_avg_df_country, country_paths['country_avg'], args.output_formats)
+
+        # Calculate weighted sums: Country level
+        with instrumentation.stage('aggregate', rows_in=len(intersections), file=forest_data_path_out, engine='groupby', result='country_sum') as record:
+            weighted_sum_df = calculate_weighted_sums.calculate_weighted_sums_country_level(intersections, variables_to_include)
+            record['rows_out'] = len(weighted_sum_df)
+        save_results(weighted_sum_df, country_paths['country_sum'], args.output_formats)
+
+#endregion
+
+#region Calculate the weights of one grid and NUTS level
+# Area and fraction weights are folded into the weight column once, not per variable
+def calculate_weights(cells, shapefile_path, cell_fractions, args, nuts_areas_by_path, shapefile_future=None):
+
+    cell_weights = load_or_calculate_cell_weights(
+        cells, shapefile_path, args.degree, args.area_method, args.overlay_method, args.overlay_workers, args.cache_dir, args.cache_max_size_mb, nuts_areas_by_path,
+        args.simplify, args.simplify_max_area_error, args.nuts_cache_dir, shapefile_future)
+    return cell_weighting.apply_weighting(cell_weights, args.weighting, cell_fractions, args.sum_factor)
+#endregion
+
+#region Prepare the aggregation jobs
+# Yields one job per (input file, overlay), the weights are built once per (grid, NUTS level).
+# 'grid_cells' gives the grid cells of each input file in order. In pipelined mode, 'shapefile_futures' are the shapefiles
+# being loaded in the background, which are waited for only when the weights are not in the cache, and
+# 'submit_weights(grid_key, *calculate_weights_args)' builds the weights in the background: the jobs have the grid key instead of the weights
+def prepare_jobs(input_files, grid_cells, args, nuts_areas_by_path, shapefile_futures=None, submit_weights=None):
+
+    cell_weights_by_key = {}
+
+    # Per-cell land or forest fractions, loaded once for all files
+    cell_fractions = None
+    if args.cell_fractions is not None:
+        cell_fractions = cell_weighting.load_cell_fractions(args.cell_fractions, args.cell_fraction_column)
+
+    for forest_data_path_out, cells in zip(input_files, grid_cells):
+        input_file_name = os.path.splitext(os.path.basename(forest_data_path_out))[0]
+
+        # The LPJ-GUESS data is exported to csv only once per file
+        export_csv_path = os.path.join(args.output_dir, 'lpj-guess_csv', input_file_name + '.csv') if args.export_csv else None
+
+        for overlay_level, levels in overlay_levels(args):
+            shapefile_path = nuts_shapefile_path(args.nuts_dir, args.nuts_scale, args.nuts_year, overlay_level)
+
+            # Files on the same grid share the weights
+            grid_key = weight_cache.weights_cache_key(cells, args.degree, shapefile_path, args.area_method, args.simplify, args.simplify_max_area_error)
+            if grid_key not in cell_weights_by_key:
+                if submit_weights is None:
+                    cell_weights_by_key[grid_key] = calculate_weights(cells, shapefile_path, cell_fractions, args, nuts_areas_by_path)
+                else:
+                    submit_weights(grid_key, cells, shapefile_path, cell_fractions, args, nuts_areas_by_path, shapefile_futures[shapefile_path])
+                    cell_weights_by_key[grid_key] = grid_key
+
+            # Country results are written once per overlay, but only the first overlay adds them to the dataset,
+            # where the country partition has no overlay level
+            paths_by_level = {level: output_paths(args.output_dir, input_file_name, f"{args.nuts_year}_{args.nuts_scale}_LEVL_{level}", level) for level in levels}
+            country_paths = output_paths(args.output_dir, input_file_name, f"{args.nuts_year}_{args.nuts_scale}_LEVL_{overlay_level}", overlay_level)
+            if overlay_level != overlay_levels(args)[0][0]:
+                for family in ['country_avg', 'country_sum', 'country_stats']:
+                    country_paths[family]['dataset'] = None
+
+            yield (forest_data_path_out, cell_weights_by_key[grid_key], levels, paths_by_level, country_paths, export_csv_path, args)
+            export_csv_path = None
+#endregion
+
+#region Create the output directories
+def create_output_directories(args):
+
+    output_writer.create_output_directories(args.output_dir, args.output_formats)
+    if args.export_csv:
+        os.makedirs(os.path.join(args.output_dir, 'lpj-guess_csv'), exist_ok=True)
+#endregion
+
+#region Batch processing
+# Each shapefile is loaded once and the weights are built once per (grid, NUTS level), the aggregations run in a process pool
+def run_batch(input_files, args):
+
+    create_output_directories(args)
+    jobs = list(prepare_jobs(input_files, (streaming_aggregation.read_grid_cells(path, args.max_memory_mb) for path in input_files), args, {}))
+
+    # Run the aggregations in the main process if there is only one worker or one job
+    if args.workers <= 1 or len(jobs) == 1:
+        for job in jobs:
+            instrumentation.add_records(aggregate_file(*job)[1])
+        return
+
+    with ProcessPoolExecutor(max_workers=min(args.workers, len(jobs))) as executor:
+        futures = [executor.submit(aggregate_file, *job) for job in jobs]
+        for future in as_completed(futures):
+            forest_data_path_out, worker_records = future.result()
+            instrumentation.add_records(worker_records)
+            print(f"** Aggregation of {forest_data_path_out} finished **")
+#endregion
+
+#region Pipelined batch processing
+# The shapefiles and the grid cells of the .out files are read concurrently in I/O threads, and the weights are built in
+# a separate thread. Each job is submitted to the process pool as soon as the grid cells of its file are read, with at most
+# 'queue_size' jobs queued or running, and waits for its weights only after the .out file is parsed. Each worker writes
+# its outputs in one background thread, so the outputs of one file are written while the next file is aggregated
+def run_batch_pipelined(input_files, args):
+
+    create_output_directories(args)
+    nuts_areas_by_path = {}
+    queue_size = args.queue_size or 2 * max(1, args.workers)
+
+    def finish(futures):
+        for future in futures:
+            forest_data_path_out, worker_records = future.result()
+            instrumentation.add_records(worker_records)
+            print(f"** Aggregation of {forest_data_path_out} finished **")
+
+    # The workers are not forked from the main process, whose I/O and weights threads may hold locks while it forks
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+    with context.Manager() as manager:
+        # The weights are published to the workers by grid key, or the error if they could not be calculated
+        shared_weights = manager.dict()
+        condition = manager.Condition()
+        worker_results = manager.Queue()
+
+        def publish_weights(grid_key, *calculate_weights_args):
+            try:
+                cell_weights = calculate_weights(*calculate_weights_args)
+            except Exception as error:
+                cell_weights = error
+            with condition:
+                shared_weights[grid_key] = cell_weights
+                condition.notify_all()
+
+        # The weights have their own thread, which never waits for the jobs, so the jobs waiting for their weights cannot block it
+        with ThreadPoolExecutor(max_workers=args.io_threads) as io_executor, ThreadPoolExecutor(max_workers=1) as weights_executor, \
+                ProcessPoolExecutor(max_workers=max(1, args.workers), mp_context=context, initializer=start_pipeline_worker,
+                                    initargs=(shared_weights, condition, worker_results)) as executor:
+            shapefile_futures = {
+                shapefile_path: io_executor.submit(load_nuts_areas, shapefile_path, nuts_areas_by_path, args.simplify, args.simplify_max_area_error, args.nuts_cache_dir)
+                for shapefile_path in [nuts_shapefile_path(args.nuts_dir, args.nuts_scale, args.nuts_year, level) for level, _ in overlay_levels(args)]
+            }
+            # The I/O threads share the memory ceiling of reading the grid cells
+            grid_cell_futures = [io_executor.submit(streaming_aggregation.read_grid_cells, path, args.max_memory_mb / args.io_threads) for path in input_files]
+
+            running = set()
+            submit_weights = lambda grid_key, *calculate_weights_args: weights_executor.submit(publish_weights, grid_key, *calculate_weights_args)
+            for job in prepare_jobs(input_files, (future.result() for future in grid_cell_futures), args, nuts_areas_by_path, shapefile_futures, submit_weights):
+                # Bounded queue: wait for a job to finish before submitting more
+                if len(running) >= queue_size:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    finish(done)
+                running.add(executor.submit(aggregate_file_pipelined, *job))
+            finish(wait(running)[0])
+
+        # The workers have exited and flushed their writers: records of the last writes and the first write error
+        write_errors = []
+        while not worker_results.empty():
+            worker_records, error = worker_results.get()
+            instrumentation.add_records(worker_records)
+            if error is not None:
+                write_errors.append(error)
+        if write_errors:
+            raise write_errors[0]
+#endregion
+
+def main(argv=None):
+    args = parse_arguments(argv)
+
+    input_files = command_line.find_input_files(args.inputs)
+    shapefile_paths = [nuts_shapefile_path(args.nuts_dir, args.nuts_scale, args.nuts_year, level) for level, _ in overlay_levels(args)]
+    if not input_files or not all(os.path.exists(path) for path in shapefile_paths):
+        print("Input files not found. Check the file paths.")
+        return
+
+    # Stages are recorded for the run report, one stage can be profiled
+    instrumentation.configure(profile_stage=args.profile_stage, profile_method=args.profile_method,
+                              profile_dir=os.path.join(args.output_dir, 'profiles'))
+
+    if args.pipelined:
+        run_batch_pipelined(input_files, args)
+    else:
+        run_batch(input_files, args)
 
-    # Create grid cell, calculate intersected areas for NUTS-areas and grid cells
-    intersections = calculate_grid_cell_and_intersected_area(forest_data, nuts_areas)
-    
-    # Calculate weighted averages: NUTS-area level
-    weighted_avg_df_nuts = calculate_weighted_averages.calculate_weighted_averages_nuts_level(intersections, variables_to_include)
-    save_results(weighted_avg_df_nuts, output_path_nuts_avg, output_path_semicolon_nuts_avg)
-    
-    # Calculate weighted averages: Country level
-    weighted_avg_df_country = calculate_weighted_averages.calculate_weighted_averages_country_level(intersections, variables_to_include)
-    save_results(weighted_avg_df_country, output_path_country_avg, output_path_semicolon_country_avg)
-
-    # Calculate weighted sums: NUTS-area level
-    weighted_sum_df = calculate_weighted_sums.calculate_weighted_sums_nuts_level(intersections, variables_to_include)
-    save_results(weighted_sum_df, output_path_sum, output_path_semicolon_sum)
-
-    # Calculate weighted sums: Country level
-    weighted_sum_df = calculate_weighted_sums.calculate_weighted_sums_country_level(intersections, variables_to_include)
-    save_results(weighted_sum_df, output_path_country_sum, output_path_semicolon_country_sum)
+    if args.report is not None:
+        instrumentation.write_report(args.report)
 
 if __name__ == "__main__":
     main()
@@ -2,31 +2,19 @@
 import os
 import geopandas as gpd
 import pandas as pd
-from shapely.geometry import Polygon
 #import re
 
 # Helpers
 import convert_and_load_data
+import grid_cell_geometry
 #import calculate_weighted_sums
 #import calculate_weighted_averages
 
-#region Create geometry for each coordinate pair. Works with any spatial resolution (degree = coordinate spacing)
-def create_geometry(data, lon_column, lat_column, degree):
-
-    # Calculate corner-points of the grid cell from the center coordinate pair
-    data['geometry'] = [
-        Polygon([(lon - degree / 2, lat - degree / 2), (lon - degree / 2, lat + degree / 2),
-                 (lon + degree / 2, lat + degree / 2), (lon + degree / 2, lat - degree / 2)])
-        for lon, lat in zip(data[lon_column], data[lat_column])
-    ]
-    return data
-#endregion
-
 #region calculate_grid_cell_and_intersected_area
 def calculate_grid_cell_and_intersected_area(forest_data, nuts_areas, save_grid_cell_surface_areas):
 
     # Add geometry column of gridd cells to forest_data (0.5-degree resolution cell grid)
-    forest_data = create_geometry(forest_data, 'Lon', 'Lat', degree=0.5)
+    forest_data = grid_cell_geometry.create_geometry_vectorized(forest_data, 'Lon', 'Lat', degree=0.5)
 
     # Create the GeoDataFrame with CRS EPSG:4326
     grid_cells = gpd.GeoDataFrame(forest_data, geometry=forest_data["geometry"], crs="EPSG:4326")
@@ -37,6 +25,9 @@ def calculate_grid_cell_and_intersected_area(forest_data, nuts_areas, save_grid_
     # Calculating the grid cell areas in km2
     grid_cells['area_km2'] = pd.to_numeric(grid_cells.geometry.area / 1000000, errors='coerce')
 
+    # Closed-form grid cell areas on the GRS80 ellipsoid, no reprojection needed
+    grid_cells['area_km2_analytic'] = grid_cell_geometry.grid_cell_area_km2(grid_cells['Lat'], degree=0.5)
+
     if save_grid_cell_surface_areas == 1:
         grid_cells.to_csv("../output/grid_cell_surface_areas/grid_cells_with_surface_areas.csv", decimal=",", sep=";", index=False)
 
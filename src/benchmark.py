@@ -0,0 +1,237 @@
+# Imports
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import platform
+import shutil
+import tempfile
+import subprocess
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+
+# Helpers
+import convert_and_load_data
+import calculate_weighted_sums
+import calculate_weighted_averages
+import grid_cell_weights
+import nuts_layer
+import instrumentation
+import sparse_aggregation
+import streaming_aggregation
+import output_writer
+import cell_weighting
+
+# Extent of the synthetic grids (Lon min, Lat min, Lon max, Lat max), covers the NUTS-areas of mainland Europe
+EUROPE_BOUNDS = (-25.0, 34.0, 45.0, 72.0)
+
+#region Generate a synthetic LPJ-GUESS .out file
+# Regular grid of cell centers at 'degree' spacing, with one row per (grid cell, year) in the LPJ-GUESS layout.
+# The variables are random values in [0, 10), the last variable is 'Total' as in the LPJ-GUESS pool outputs
+def generate_synthetic_out(path, degree, n_years, n_variables, first_year=2000, bounds=EUROPE_BOUNDS, seed=0):
+
+    lon = np.arange(bounds[0] + degree / 2, bounds[2], degree)
+    lat = np.arange(bounds[1] + degree / 2, bounds[3], degree)
+    cell_lon, cell_lat = [grid.ravel() for grid in np.meshgrid(lon, lat)]
+
+    # Rows are grouped by grid cell, years in order
+    n_rows = len(cell_lon) * n_years
+    variables = [f"Var{variable + 1}" for variable in range(n_variables - 1)] + ['Total']
+    values = np.random.default_rng(seed).random((n_rows, n_variables)) * 10
+
+    data = pd.DataFrame({
+        'Lon': np.repeat(cell_lon, n_years).round(4),
+        'Lat': np.repeat(cell_lat, n_years).round(4),
+        'Year': np.tile(np.arange(first_year, first_year + n_years), len(cell_lon)),
+    })
+    data[variables] = values.round(3)
+    data.to_csv(path, sep=' ', index=False, float_format='%.6g')
+
+    return len(cell_lon), n_rows
+#endregion
+
+#region Time one stage
+# The progress prints of the pipeline are hidden, the wall time is added to 'timings'
+def timed(timings, stage, function, *args, **kwargs):
+
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        result = function(*args, **kwargs)
+    timings[stage] = time.perf_counter() - start
+    return result
+#endregion
+
+#region Run the pipeline once, stage by stage
+# Times the functions that the pipeline runs (LPJ-GUESS_aggregation.aggregate_file and its helpers), one call per stage
+def run_stages(out_path, shapefile_path, degree, levels, output_formats, output_dir, max_memory_mb):
+
+    timings = {}
+    forest_data = timed(timings, 'parse', convert_and_load_data.read_out_file, out_path)
+    timed(timings, 'parse_grid_cells', streaming_aggregation.read_grid_cells, out_path, max_memory_mb)
+
+    # NUTS layer from the shapefile, and from the GeoParquet cache of a previous run
+    nuts_areas = timed(timings, 'load_shapefile', nuts_layer.load_nuts_layer, shapefile_path)
+    layer_cache_dir = os.path.join(output_dir, 'nuts_cache')
+    shutil.rmtree(layer_cache_dir, ignore_errors=True)
+    timed({}, 'write_layer_cache', nuts_layer.load_nuts_layer, shapefile_path, cache_dir=layer_cache_dir)
+    timed(timings, 'load_shapefile_cached', nuts_layer.load_nuts_layer, shapefile_path, cache_dir=layer_cache_dir)
+
+    # Cell weights, the geometry, reprojection and overlay times are taken from the stages recorded inside calculate_cell_weights
+    instrumentation.configure()
+    instrumentation.take_records()
+    cell_weights = timed(timings, 'cell_weights', grid_cell_weights.calculate_cell_weights, forest_data, nuts_areas, degree=degree)
+    stage_records = instrumentation.take_records()
+    for stage in ['geometry', 'reprojection', 'overlay']:
+        timings[stage] = sum(record['seconds'] for record in stage_records if record['stage'] == stage)
+    timed(timings, 'cell_weights_analytic', grid_cell_weights.calculate_cell_weights, forest_data, nuts_areas, degree=degree, area_method='analytic')
+    instrumentation.take_records()
+
+    # Area weighting of the cell weights, from the 'weighting' stage of apply_weighting
+    cell_weighting.apply_weighting(cell_weights, 'area')
+    timings['weighting'] = sum(record['seconds'] for record in instrumentation.take_records() if record['stage'] == 'weighting')
+
+    variables = [column for column in forest_data.columns if column not in ['Lon', 'Lat', 'Year']]
+    data_matrix = timed(timings, 'data_matrix', sparse_aggregation.build_data_matrix, forest_data, variables)
+
+    # Sparse engine: W @ X once, then one roll-up per NUTS level and country
+    nuts_totals = timed(timings, 'aggregation_sparse_totals', sparse_aggregation.calculate_weighted_totals, cell_weights, data_matrix)
+    for level in levels:
+        timed(timings, f'aggregation_sparse_nuts_{level}', lambda: sparse_aggregation.weighted_totals_to_frames(
+            sparse_aggregation.rollup_weighted_totals(nuts_totals, 2 + level), 'NUTS_ID'))
+    results = timed(timings, 'aggregation_sparse_all_levels', sparse_aggregation.weighted_totals_to_frames_by_level, nuts_totals, levels)
+
+    # Groupby engine
+    intersections = timed(timings, 'aggregation_groupby_join', grid_cell_weights.join_cell_weights, cell_weights, forest_data)
+    timed(timings, 'aggregation_groupby_nuts_avg', calculate_weighted_averages.calculate_weighted_averages_nuts_level, intersections, variables)
+    timed(timings, 'aggregation_groupby_nuts_sum', calculate_weighted_sums.calculate_weighted_sums_nuts_level, intersections, variables)
+    timed(timings, 'aggregation_groupby_country_avg', calculate_weighted_averages.calculate_weighted_averages_country_level, intersections, variables)
+    timed(timings, 'aggregation_groupby_country_sum', calculate_weighted_sums.calculate_weighted_sums_country_level, intersections, variables)
+
+    # Streaming engine, reads the .out file again in chunks
+    timed(timings, 'aggregation_streaming', streaming_aggregation.calculate_weighted_totals_streaming, out_path, cell_weights, max_memory_mb)
+
+    # Output of the four result families of the finest level, one format at a time
+    for output_format in output_formats:
+        output_writer.create_output_directories(output_dir, [output_format])
+
+        def save_all():
+            for family, weighted_df in zip(['nuts_sum', 'nuts_avg', 'country_sum', 'country_avg'], [*results[max(levels)], *results['Country']]):
+                paths = {
+                    'parquet': os.path.join(output_dir, 'parquet', family + '.parquet'),
+                    'feather': os.path.join(output_dir, 'feather', family + '.feather'),
+                    'csv': os.path.join(output_dir, 'csv', family + '.csv'),
+                    'excel': os.path.join(output_dir, 'excel', family + '_excel.csv'),
+                    'dataset': (os.path.join(output_dir, 'dataset', 'benchmark'), family.split('_')[0], family.split('_')[1], 'benchmark'),
+                }
+                output_writer.save_results(weighted_df, paths, [output_format])
+        timed(timings, f'output_{output_format}', save_all)
+
+    counts = {'rows': len(forest_data), 'cells': len(forest_data[['Lon', 'Lat']].drop_duplicates()), 'regions': len(nuts_areas), 'pairs': len(cell_weights)}
+    return timings, counts
+#endregion
+
+#region Environment of the run
+def environment():
+
+    versions = {}
+    for module in ['numpy', 'pandas', 'geopandas', 'shapely', 'scipy', 'pyarrow']:
+        try:
+            versions[module] = __import__(module).__version__
+        except ImportError:
+            versions[module] = None
+
+    # Commit of the code, if run inside the git repository
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'git_commit': commit,
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'versions': versions,
+    }
+#endregion
+
+#region Command line arguments
+def parse_arguments(argv=None):
+
+    parser = argparse.ArgumentParser(description="Time each stage of the aggregation on synthetic LPJ-GUESS grids and the bundled NUTS shapefiles.")
+    parser.add_argument('--degrees', nargs='+', type=float, default=[0.5], help="Grid cell sizes in degrees (default: %(default)s)")
+    parser.add_argument('--years', nargs='+', type=int, default=[1, 10], help="Numbers of years (default: %(default)s)")
+    parser.add_argument('--variables', nargs='+', type=int, default=[4], help="Numbers of variables, including 'Total' (default: %(default)s)")
+    parser.add_argument('--nuts-scales', nargs='+', default=['60M', '20M', '10M', '03M', '01M'],
+                        help="Scales of the NUTS shapefiles, missing shapefiles are skipped (default: %(default)s)")
+    parser.add_argument('--nuts-level', type=int, default=3, choices=[0, 1, 2, 3],
+                        help="NUTS level of the overlay, the sparse results are rolled up to all coarser levels (default: %(default)s)")
+    parser.add_argument('--nuts-dir', default='../input_data/nuts_data/', help="Directory of the NUTS shapefiles (default: %(default)s)")
+    parser.add_argument('--nuts-year', default='2021', help="Year of the NUTS shapefiles (default: %(default)s)")
+    parser.add_argument('--output-formats', nargs='+', choices=output_writer.OUTPUT_FORMATS, default=['parquet', 'csv', 'excel'],
+                        help="Output formats to time (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per case, the fastest run of each stage is reported (default: %(default)s)")
+    parser.add_argument('--max-memory-mb', type=float, default=4096, help="Memory ceiling of the streaming stage (default: %(default)s)")
+    parser.add_argument('--work-dir', default=None, help="Directory for the synthetic .out files and outputs (default: temporary directory)")
+    parser.add_argument('--results', default='../output/benchmark/', help="Directory of the JSON results (default: %(default)s)")
+    return parser.parse_args(argv)
+#endregion
+
+def main(argv=None):
+    args = parse_arguments(argv)
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        work_dir = args.work_dir or temporary_dir
+        os.makedirs(work_dir, exist_ok=True)
+
+        report = {'environment': environment(), 'arguments': vars(args), 'cases': [], 'skipped': []}
+        levels = list(range(args.nuts_level + 1))
+
+        for degree in args.degrees:
+            for n_years in args.years:
+                for n_variables in args.variables:
+                    # Synthetic .out files are reused between runs with the same work directory
+                    out_path = os.path.join(work_dir, f"synthetic_{degree}deg_{n_years}y_{n_variables}v.out")
+                    if not os.path.exists(out_path):
+                        start = time.perf_counter()
+                        generate_synthetic_out(out_path, degree, n_years, n_variables)
+                        print(f"** Synthetic .out file {out_path} generated in {time.perf_counter() - start:.1f} s **")
+
+                    for nuts_scale in args.nuts_scales:
+                        shapefile_path = os.path.join(args.nuts_dir, f"NUTS_RG_{nuts_scale}_{args.nuts_year}_3035_LEVL_{args.nuts_level}.shp")
+                        if not os.path.exists(shapefile_path):
+                            print(f"** Shapefile {shapefile_path} not found, skipped **")
+                            report['skipped'].append(shapefile_path)
+                            continue
+
+                        # Fastest run of each stage
+                        runs = []
+                        for _ in range(args.repeat):
+                            timings, counts = run_stages(out_path, shapefile_path, degree, levels, args.output_formats,
+                                                         os.path.join(work_dir, 'output'), args.max_memory_mb)
+                            runs.append(timings)
+                        best = {stage: min(run[stage] for run in runs) for stage in runs[0]}
+
+                        report['cases'].append({
+                            'degree': degree, 'years': n_years, 'variables': n_variables, 'nuts_scale': nuts_scale,
+                            'nuts_level': args.nuts_level, **counts,
+                            'seconds': best, 'seconds_all_runs': {stage: [run[stage] for run in runs] for stage in runs[0]},
+                        })
+                        # The overlay is part of the cell_weights stage
+                        print(f"** {degree} deg, {n_years} years, {n_variables} variables, NUTS {nuts_scale}: "
+                              f"{counts['cells']} cells, {counts['pairs']} pairs, {sum(seconds for stage, seconds in best.items() if stage != 'overlay'):.2f} s **")
+
+    os.makedirs(args.results, exist_ok=True)
+    results_path = os.path.join(args.results, f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(results_path, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"** Benchmark results saved to {results_path} **")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+# Helpers
+import instrumentation
+
+# Weightings of the aggregation
+# - fraction: portion of the grid cell in the region (intersection_weight), the sums are in the units of the LPJ-GUESS variables
+# - area: intersected area in km2 (intersection_area_km2), the sums are regional totals, e.g. kg C/m2 x km2 = 10^6 kg C = 10^-3 Tg C
+WEIGHTINGS = ['fraction', 'area']
+
+#region Load per-cell fractions
+# Table of the land or forest fraction of each grid cell, e.g. an LPJ-GUESS landcover output or a csv exported from a raster.
+# Whitespace, comma or semicolon separated, with Lon, Lat and the fraction column (0-1)
+def load_cell_fractions(path, fraction_column=None):
+
+    cell_fractions = pd.read_csv(path, sep=None, engine='python')
+    if 'Lon' not in cell_fractions.columns or 'Lat' not in cell_fractions.columns:
+        raise ValueError(f"Cell fraction file {path} must have 'Lon' and 'Lat' columns.")
+    if 'Year' in cell_fractions.columns:
+        raise ValueError(f"Cell fraction file {path} has a 'Year' column, select the rows of one year first.")
+
+    # The only other column is the fraction if no column is given
+    if fraction_column is None:
+        value_columns = [column for column in cell_fractions.columns if column not in ['Lon', 'Lat']]
+        if len(value_columns) != 1:
+            raise ValueError(f"Cell fraction file {path} has the columns {value_columns}, select one with the fraction column argument.")
+        fraction_column = value_columns[0]
+
+    fractions = pd.to_numeric(cell_fractions[fraction_column], errors='coerce')
+    tolerance = 1e-6
+    if not fractions.between(0 - tolerance, 1 + tolerance).all():
+        raise ValueError(f"Some fractions in column '{fraction_column}' of {path} are missing or outside [0, 1].")
+
+    print(f"4: Cell fractions '{fraction_column}' loaded from {path} for {len(cell_fractions)} grid cells")
+    return pd.DataFrame({'Lon': cell_fractions['Lon'].astype(np.float64), 'Lat': cell_fractions['Lat'].astype(np.float64),
+                         'cell_fraction': fractions.clip(0, 1).to_numpy()}).drop_duplicates(['Lon', 'Lat'])
+#endregion
+
+#region Apply the weighting to the cell weights
+# The aggregation weight replaces 'intersection_weight', so every engine (sparse, streaming, groupby, statistics) uses it in
+# its normal pass: weight = (intersection_weight or intersection_area_km2) x cell fraction x sum_factor.
+# The averages do not depend on sum_factor, it only scales the sums (e.g. 0.001 for kg/m2 x km2 -> Tg)
+def apply_weighting(cell_weights, weighting='fraction', cell_fractions=None, sum_factor=1.0):
+
+    if weighting == 'fraction' and cell_fractions is None and sum_factor == 1.0:
+        return cell_weights
+
+    with instrumentation.stage('weighting', rows_in=len(cell_weights), weighting=weighting) as record:
+        weighted = cell_weights.copy()
+        weights = weighted['intersection_area_km2' if weighting == 'area' else 'intersection_weight'].to_numpy(dtype=np.float64)
+
+        if cell_fractions is not None:
+            # Grid cells without a fraction have no land or forest
+            weighted = weighted.merge(cell_fractions, on=['Lon', 'Lat'], how='left')
+            missing = weighted['cell_fraction'].isna()
+            if missing.any():
+                print(f"** {weighted.loc[missing, ['Lon', 'Lat']].drop_duplicates().shape[0]} grid cells have no cell fraction, their weight is 0 **")
+            weighted['cell_fraction'] = weighted['cell_fraction'].fillna(0.0)
+            weights = weights * weighted['cell_fraction'].to_numpy()
+
+        # Pairs without weight are dropped, as the pairs without intersected area in the overlay
+        weighted['intersection_weight'] = weights * sum_factor
+        weighted = weighted[weighted['intersection_weight'] > 0].reset_index(drop=True)
+        record['rows_out'] = len(weighted)
+    return weighted
+#endregion
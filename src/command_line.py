@@ -0,0 +1,79 @@
+# Imports
+import os
+import glob
+
+# Helpers
+import cell_weighting
+import output_writer
+
+#region Input files
+# Find the .out files from directories and glob patterns
+def find_input_files(inputs):
+
+    input_files = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.out')
+        input_files.extend(sorted(glob.glob(pattern)))
+
+    # Remove duplicates, keep the order
+    return list(dict.fromkeys(input_files))
+#endregion
+
+#region Output paths
+# Output file paths for each result family and output format - *Note: "excel" paths are for easy access in excel*
+# 'families' = {family: (file name prefix, dataset level, dataset statistic)}, the files are named <prefix><input>_<name_suffix>
+def output_paths(output_dir, input_file_name, name_suffix, families):
+
+    name = input_file_name + '_' + name_suffix
+
+    paths = {}
+    for family, (prefix, dataset_level, statistic) in families.items():
+        paths[family] = {
+            'parquet': os.path.join(output_dir, 'parquet', prefix + name + '.parquet'),
+            'feather': os.path.join(output_dir, 'feather', prefix + name + '.feather'),
+            'csv': os.path.join(output_dir, 'csv', prefix + name + '.csv'),
+            'excel': os.path.join(output_dir, 'excel', prefix + name + '_excel.csv'),
+            'dataset': (os.path.join(output_dir, 'dataset', input_file_name), dataset_level, statistic, name),
+        }
+    return paths
+#endregion
+
+#region Command line arguments shared by LPJ-GUESS_aggregation.py and regrid.py
+# The .out files and how they are read
+def add_input_arguments(parser):
+
+    parser.add_argument('inputs', nargs='*', default=['../input_data/lpj-guess_out/cpool.out'],
+                        help="LPJ-GUESS .out files, directories or glob patterns (default: %(default)s)")
+    parser.add_argument('--degree', type=float, default=0.5, help="Grid cell size of the LPJ-GUESS data in degrees (default: %(default)s)")
+    parser.add_argument('--float32', action='store_true', help="Load the LPJ-GUESS variables as float32 to halve the memory use")
+    parser.add_argument('--max-memory-mb', type=float, default=4096,
+                        help="Approximate memory ceiling per worker of the chunked reading (the grid cells, and the whole .out files with --streaming), sets the chunk size (default: %(default)s)")
+
+# The cell weights, their cache and the weighting of the grid cells. 'weighting' = default weighting
+def add_weight_arguments(parser, weighting):
+
+    parser.add_argument('--area-method', choices=['projected', 'analytic'], default='projected',
+                        help="Grid cell area: polygon area in the equal-area CRS or closed-form area on the GRS80 ellipsoid (default: %(default)s)")
+    parser.add_argument('--overlay-method', choices=['strtree', 'overlay'], default='strtree',
+                        help="Spatial index with interior cell shortcut, or gpd.overlay of all grid cells (default: %(default)s)")
+    parser.add_argument('--overlay-workers', type=int, default=1,
+                        help="Worker processes for the strtree overlay, the grid is split into spatial tiles (default: %(default)s)")
+    parser.add_argument('--cache-dir', default='../output/weight_cache/', help="Cache directory for the cell weights (default: %(default)s)")
+    parser.add_argument('--cache-max-size-mb', type=float, default=512,
+                        help="Least recently used cache files are removed above this size (default: %(default)s)")
+    parser.add_argument('--weighting', choices=cell_weighting.WEIGHTINGS, default=weighting,
+                        help="Weight the grid cells by the intersected portion of the cell (fraction) or by the intersected km2 (area) (default: %(default)s)")
+    parser.add_argument('--cell-fractions', default=None,
+                        help="Table of a land or forest fraction per grid cell (Lon, Lat, fraction), multiplied into the weights")
+    parser.add_argument('--cell-fraction-column', default=None, help="Fraction column of --cell-fractions, if the table has several")
+    parser.add_argument('--sum-factor', type=float, default=1.0,
+                        help="Factor of the weighted sums, e.g. 0.001 with '--weighting area' for kg/m2 -> Tg (default: %(default)s)")
+
+# Where and how the results are saved
+def add_output_arguments(parser):
+
+    parser.add_argument('--output-dir', default='../output/', help="Output directory (default: %(default)s)")
+    parser.add_argument('--output-formats', nargs='+', choices=output_writer.OUTPUT_FORMATS, default=['parquet'],
+                        help="Output formats: parquet/feather files, csv/excel text variants and/or one partitioned Parquet dataset per input (default: %(default)s)")
+#endregion
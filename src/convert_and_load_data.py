@@ -3,22 +3,101 @@ import geopandas as gpd
 import pandas as pd
 
 #region Convert out to csv 
-# *Selfnote: This could be removed and use .out files for the calculations
+# Optional export, the calculations read the .out files directly with read_out_file
 def convert_out_file_to_csv(input_file, output_file):
     
+    # Stream the file line by line instead of reading the whole file into memory
+    with open(input_file, "r") as file, open(output_file, "w", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+
+        # Write header and data to a CSV file
+        for line in file:
+            if line.strip():
+                writer.writerow(line.split())
+    print(f"1: .out file {input_file} transformed to {output_file}")
+#endregion
+
+#region Column types of LPJ-GUESS .out files
+# Lon and Lat are kept as float64 so that the cell coordinates match exactly, variable columns can be float32
+def out_file_dtypes(input_file, variable_dtype):
+
+    # Read only the header line
     with open(input_file, "r") as file:
-        lines = file.readlines()
+        header = file.readline().split()
 
-    # Extract the header and data
-    header = lines[0].strip().split()
-    data = [line.strip().split() for line in lines[1:]]
+    return {column: ('float64' if column in ['Lon', 'Lat'] else 'int32' if column == 'Year' else variable_dtype) for column in header}
+#endregion
 
-    # Write header and data to a CSV file
-    with open(output_file, "w", newline="") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(header)
-        writer.writerows(data)
-    print(f"1: .out file {input_file} transformed to {output_file}")
+#region Read LPJ-GUESS .out file directly
+# Parses the whitespace-delimited .out file into typed columns. With chunksize, returns an iterator of DataFrames.
+# usecols = columns to parse, None = all columns. Non-numeric values are read as missing values: if the typed parsing fails,
+# the file (or the rest of it) is read again as text and converted with coerce_out_values
+def read_out_file(input_file, variable_dtype='float64', chunksize=None, usecols=None):
+
+    dtypes = out_file_dtypes(input_file, variable_dtype)
+    if chunksize is not None:
+        return read_out_file_chunks(input_file, dtypes, chunksize, usecols)
+
+    try:
+        return pd.read_csv(input_file, sep=r'\s+', dtype=dtypes, usecols=usecols)
+    except ValueError:
+        df, n_invalid, n_dropped = coerce_out_values(pd.read_csv(input_file, sep=r'\s+', dtype=str, usecols=usecols), dtypes)
+        print_coerced_values(input_file, n_invalid, n_dropped)
+        return df
+
+def read_out_file_chunks(input_file, dtypes, chunksize, usecols):
+
+    rows_read = 0
+    try:
+        for chunk in pd.read_csv(input_file, sep=r'\s+', dtype=dtypes, chunksize=chunksize, usecols=usecols):
+            rows_read += len(chunk)
+            yield chunk
+        return
+    except ValueError:
+        pass
+
+    # The chunks already returned are skipped, the rest of the file is read as text
+    total_invalid, total_dropped = 0, 0
+    for chunk in pd.read_csv(input_file, sep=r'\s+', dtype=str, chunksize=chunksize, usecols=usecols, skiprows=range(1, 1 + rows_read)):
+        chunk, n_invalid, n_dropped = coerce_out_values(chunk, dtypes)
+        total_invalid += n_invalid
+        total_dropped += n_dropped
+        yield chunk
+    print_coerced_values(input_file, total_invalid, total_dropped)
+#endregion
+
+#region Convert non-numeric values to missing values
+# Stray tokens (e.g. '*****' of a number too wide for its column) become missing values, as in the sums of pandas.
+# Rows without a valid Lon, Lat or Year cannot be assigned to a grid cell and year, and are dropped.
+# Returns the typed DataFrame, the number of missing or non-numeric values and the number of dropped rows
+def coerce_out_values(text_df, dtypes):
+
+    numeric_df = text_df.apply(pd.to_numeric, errors='coerce')
+    n_invalid = int((numeric_df.isna() & text_df.notna()).sum().sum())
+
+    key_columns = [column for column in ['Lon', 'Lat', 'Year'] if column in numeric_df.columns]
+    invalid_keys = numeric_df[key_columns].isna().any(axis=1)
+    numeric_df = numeric_df[~invalid_keys]
+
+    return numeric_df.astype({column: dtypes[column] for column in numeric_df.columns}), n_invalid, int(invalid_keys.sum())
+
+def print_coerced_values(input_file, n_invalid, n_dropped):
+
+    print(f"** {n_invalid} missing or non-numeric values in '{input_file}' are read as missing values"
+          f"{f', {n_dropped} rows without valid Lon, Lat or Year are dropped' if n_dropped else ''} **")
+#endregion
+
+#region Load data for LPJ-GUESS .out file
+def load_data_out(forest_data_path_out, variable_dtype='float64'):
+
+    # Save forest data
+    try:
+        forest_data = read_out_file(forest_data_path_out, variable_dtype)
+        print(f"3: Forest data '{forest_data_path_out}' loaded into 'forest_data'")
+    except FileNotFoundError:
+        print(f"Error: File {forest_data_path_out} not found.")
+        exit(1)
+    return forest_data
 #endregion
 
 #region Load data for LPJ-GUESS and NUTS-areas
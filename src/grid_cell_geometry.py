@@ -0,0 +1,55 @@
+import numpy as np
+import shapely
+from shapely.geometry import Polygon
+
+# GRS80 ellipsoid, used by EPSG:3035 (ETRS89-LAEA)
+GRS80_SEMI_MAJOR_AXIS = 6378137.0
+GRS80_FLATTENING = 1 / 298.257222101
+
+#region Create geometry for each coordinate pair. Works with any spatial resolution (degree = coordinate spacing)
+# Per-row version, kept for validation of the vectorized version
+def create_geometry(data, lon_column, lat_column, degree):
+
+    # Calculate corner-points of the grid cell from the center coordinate pair
+    data['geometry'] = [
+        Polygon([(lon - degree / 2, lat - degree / 2), (lon - degree / 2, lat + degree / 2),
+                 (lon + degree / 2, lat + degree / 2), (lon + degree / 2, lat - degree / 2)])
+        for lon, lat in zip(data[lon_column], data[lat_column])
+    ]
+    return data
+#endregion
+
+#region Create geometry for all coordinate pairs at once
+# Same grid cells as create_geometry, built with the vectorized shapely 2 constructor
+def create_geometry_vectorized(data, lon_column, lat_column, degree):
+
+    lon = data[lon_column].to_numpy(dtype=np.float64)
+    lat = data[lat_column].to_numpy(dtype=np.float64)
+    data['geometry'] = shapely.box(lon - degree / 2, lat - degree / 2, lon + degree / 2, lat + degree / 2)
+    return data
+#endregion
+
+#region Ellipsoid area between the equator and a latitude
+# q(lat) of the authalic latitude formula, the area of a band between two latitudes is b^2 * dlon / 2 * (q(lat2) - q(lat1))
+def authalic_q(lat_radians):
+
+    e2 = GRS80_FLATTENING * (2 - GRS80_FLATTENING)
+    e = np.sqrt(e2)
+    sin_lat = np.sin(lat_radians)
+    return sin_lat / (1 - e2 * sin_lat ** 2) + np.log((1 + e * sin_lat) / (1 - e * sin_lat)) / (2 * e)
+#endregion
+
+#region Calculate grid cell areas in closed form
+# The area of a regular lat/lon grid cell on the ellipsoid depends only on its latitude, so it is calculated once per latitude band
+def grid_cell_area_km2(lat, degree):
+
+    # One value per distinct latitude, mapped back to all cells
+    lat_bands, band_index = np.unique(np.asarray(lat, dtype=np.float64), return_inverse=True)
+
+    e2 = GRS80_FLATTENING * (2 - GRS80_FLATTENING)
+    b2 = GRS80_SEMI_MAJOR_AXIS ** 2 * (1 - e2)
+    half_cell = np.radians(degree / 2)
+    band_area_m2 = b2 * np.radians(degree) / 2 * (authalic_q(np.radians(lat_bands) + half_cell) - authalic_q(np.radians(lat_bands) - half_cell))
+
+    return band_area_m2[band_index] / 1000000
+#endregion
@@ -0,0 +1,116 @@
+import geopandas as gpd
+import pandas as pd
+
+# Helpers
+import grid_cell_geometry
+import intersect_grid_cells
+import instrumentation
+
+#region Calculate cell weights: one row per (grid cell, NUTS-area) pair
+# The NUTS-areas can be any target polygons (coarser grids, reference grids, catchments): 'id_column' is the region ID column
+# of the target polygons and of the weights, and 'crs' is the equal-area CRS of the areas (EPSG:3035 for Europe).
+# area_method: 'projected' = area of the grid cell polygon in EPSG:3035, 'analytic' = closed-form cell area on the GRS80 ellipsoid.
+# The weights are always the intersected portion of the projected polygon, 'analytic' only changes the reported km2 columns.
+# overlay_method: 'strtree' = spatial index with interior cell shortcut, 'overlay' = gpd.overlay of all grid cells.
+# With overlay_workers > 1, the 'strtree' intersections run in spatial tiles in a process pool
+def calculate_cell_weights(forest_data, nuts_areas, degree=0.5, area_method='projected', per_row_geometry=False, overlay_method='strtree', overlay_workers=1,
+                           id_column='NUTS_ID', crs="EPSG:3035"):
+
+    # Keep only the distinct grid cells - the same (Lon, Lat) appears once per year in the LPJ-GUESS data
+    cells = forest_data[['Lon', 'Lat']].drop_duplicates().reset_index(drop=True)
+
+    with instrumentation.stage('geometry', rows_in=len(cells), per_row=per_row_geometry) as record:
+        # Add geometry column of grid cells (0.5-degree resolution cell grid by default)
+        if per_row_geometry:
+            cells = grid_cell_geometry.create_geometry(cells, 'Lon', 'Lat', degree=degree)
+        else:
+            cells = grid_cell_geometry.create_geometry_vectorized(cells, 'Lon', 'Lat', degree=degree)
+
+        # Create the GeoDataFrame with CRS EPSG:4326
+        grid_cells = gpd.GeoDataFrame(cells, geometry=cells["geometry"], crs="EPSG:4326")
+        record['rows_out'] = len(grid_cells)
+
+    with instrumentation.stage('reprojection', rows_in=len(grid_cells), crs=crs) as record:
+        # Update the EPSG to meters
+        grid_cells = grid_cells.to_crs(crs)
+
+        # Set the same EPSG for NUTS-areas, only the ID column is needed from the attributes. The NUTS shapefiles are already in EPSG:3035
+        nuts_areas = nuts_areas[[id_column, 'geometry']]
+        if nuts_areas.crs is None or not nuts_areas.crs.equals(crs):
+            nuts_areas = nuts_areas.to_crs(crs)
+        record['rows_out'] = len(grid_cells)
+
+    # Calculating the grid cell areas in km2
+    grid_cells['area_km2'] = pd.to_numeric(grid_cells.geometry.area / 1000000, errors='coerce')
+    
+    with instrumentation.stage('overlay', rows_in=len(cells), method=overlay_method, workers=overlay_workers) as record:
+        if overlay_method == 'strtree':
+            # Candidate pairs from the spatial index, only the grid cells on NUTS-area boundaries are clipped
+            if overlay_workers > 1:
+                cell_index, nuts_index, intersection_area = intersect_grid_cells.intersect_cells_parallel(
+                    grid_cells.geometry.to_numpy(), nuts_areas.geometry.to_numpy(), overlay_workers)
+            else:
+                cell_index, nuts_index, intersection_area = intersect_grid_cells.intersect_cells_strtree(
+                    grid_cells.geometry.to_numpy(), nuts_areas.geometry.to_numpy())
+            intersections = pd.DataFrame({
+                'Lon': grid_cells['Lon'].to_numpy()[cell_index],
+                'Lat': grid_cells['Lat'].to_numpy()[cell_index],
+                id_column: nuts_areas[id_column].to_numpy()[nuts_index],
+                'area_km2': grid_cells['area_km2'].to_numpy()[cell_index],
+                'intersection_area_km2': intersection_area / 1000000,
+            })
+        else:
+            # Spatial intersections of grid cells and nuts_areas - the overlapping area of grid cells with NUTS-areas
+            intersections = gpd.overlay(grid_cells, nuts_areas, how='intersection')
+
+            # Calculate the intersected area for each grid cell
+            intersections['intersection_area_km2'] = pd.to_numeric(intersections['geometry'].area / 1000000, errors='coerce')
+        record['rows_out'] = len(intersections)
+
+    # Weight = portion of the grid cell that intersects with the NUTS-area
+    intersections['intersection_weight'] = pd.to_numeric(intersections['intersection_area_km2'] / intersections['area_km2'], errors='coerce')
+
+    # Check that all intersection weights are between 0 and 1
+    tolerance = 1e-10
+    if not intersections['intersection_weight'].between(0 - tolerance, 1 + tolerance).all():
+        raise ValueError("Some weights are outside the expected range of [0, 1].")
+
+    # Replace the projected areas with the ellipsoid areas, the intersected area keeps the same portion of the grid cell
+    if area_method == 'analytic':
+        intersections['area_km2'] = grid_cell_geometry.grid_cell_area_km2(intersections['Lat'], degree)
+        intersections['intersection_area_km2'] = intersections['intersection_weight'] * intersections['area_km2']
+
+    # Drop the geometry, the weights are kept as a compact table
+    cell_weights = pd.DataFrame(intersections[['Lon', 'Lat', id_column, 'area_km2', 'intersection_area_km2', 'intersection_weight']])
+
+    # Print progress
+    print(f"5: Grid cells created and intersected areas calculated for {len(cells)} grid cells")
+
+    return cell_weights
+#endregion
+
+#region Join the yearly values onto the cell weights
+def join_cell_weights(cell_weights, forest_data):
+
+    # Load the NUTS region surface area data csv's
+    #nuts_surface_area_df = pd.read_csv("../input_data/filtered_nuts2_surface_areas_landuse_total.csv", sep=';')
+    
+    # Keep only relevant columns
+    #nuts_surface_area_df = nuts_surface_area_df[['NUTS_ID', 'official_surface_area_2021']]
+    
+    # Merge with the intersections GeoDataFrame on NUTS_ID
+    #cell_weights = cell_weights.merge(nuts_surface_area_df, on='NUTS_ID', how='left')
+
+    # Join the yearly values onto the (grid cell, NUTS-area) pairs
+    intersections = cell_weights.merge(forest_data, on=['Lon', 'Lat'], how='inner')
+
+    return intersections
+#endregion
+
+#region calculate_grid_cell_and_intersected_area
+def calculate_grid_cell_and_intersected_area(forest_data, nuts_areas, id_column='NUTS_ID', crs="EPSG:3035"):
+
+    # Intersect each distinct grid cell once, then add the yearly values
+    cell_weights = calculate_cell_weights(forest_data, nuts_areas, id_column=id_column, crs=crs)
+    return join_cell_weights(cell_weights, forest_data)
+#endregion
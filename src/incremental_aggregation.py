@@ -0,0 +1,151 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+# Helpers
+import sparse_aggregation
+import output_writer
+import instrumentation
+
+# Bump when the manifest layout or the checksums change
+MANIFEST_VERSION = 1
+
+# Output formats that can be read back for merging, in order of preference
+READABLE_FORMATS = ['parquet', 'feather', 'csv', 'excel']
+
+#region Manifest path
+# One manifest per input file and overlay, e.g. <output_dir>/manifest/cpool_2021_01M_LEVL_2.json
+def manifest_path(output_dir, name):
+    return os.path.join(output_dir, 'manifest', name + '.json')
+#endregion
+
+#region Checksums
+# One checksum per year over the (Lon, Lat, Year, variables) rows of the year, independent of the row order
+def year_checksums(forest_data):
+
+    ordered = forest_data.sort_values(['Year', 'Lon', 'Lat'], kind='stable')
+    row_hashes = pd.util.hash_pandas_object(ordered, index=False).to_numpy()
+    years, starts = np.unique(ordered['Year'].to_numpy(), return_index=True)
+    ends = np.append(starts[1:], len(ordered))
+
+    return {str(year): hashlib.sha256(row_hashes[start:end].tobytes()).hexdigest() for year, start, end in zip(years, starts, ends)}
+
+# Checksum of the cell weights, a changed overlay changes every year
+def cell_weights_checksum(cell_weights):
+
+    row_hashes = pd.util.hash_pandas_object(cell_weights[['Lon', 'Lat', 'NUTS_ID', 'intersection_weight']], index=False).to_numpy()
+    return hashlib.sha256(row_hashes.tobytes()).hexdigest()
+#endregion
+
+#region Load and save the manifest
+# Returns None if there is no manifest or it cannot be used
+def load_manifest(path):
+
+    try:
+        with open(path) as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+# Written to a temporary file and renamed, so an interrupted run never leaves a partial manifest
+def save_manifest(path, run_settings, checksums):
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = path + '.tmp'
+    with open(temporary_path, "w") as file:
+        json.dump({'version': MANIFEST_VERSION, 'settings': run_settings, 'years': checksums}, file, indent=2)
+    os.replace(temporary_path, path)
+#endregion
+
+#region Compare the input with the manifest
+# Returns (years to aggregate, years to remove from the outputs, full run).
+# Without a manifest of the same settings and weights, all years are aggregated and the outputs are replaced (full run)
+def changed_years(manifest, run_settings, checksums):
+
+    if manifest is None or manifest['settings'] != run_settings:
+        return sorted(int(year) for year in checksums), [], True
+
+    previous = manifest['years']
+    new_or_changed = sorted(int(year) for year, checksum in checksums.items() if previous.get(year) != checksum)
+    removed = sorted(int(year) for year in previous if year not in checksums)
+    return new_or_changed, removed, False
+#endregion
+
+#region Load existing results
+# Reads the first readable output format of one result family, None if none of them exists
+def load_existing_results(paths, output_formats):
+
+    for output_format in READABLE_FORMATS:
+        if output_format not in output_formats or not os.path.exists(paths[output_format]):
+            continue
+        if output_format == 'parquet':
+            return pd.read_parquet(paths['parquet'])
+        if output_format == 'feather':
+            return pd.read_feather(paths['feather'])
+        if output_format == 'csv':
+            return pd.read_csv(paths['csv'], keep_default_na=False, na_values=[''], float_precision='round_trip')
+        return pd.read_csv(paths['excel'], sep=';', decimal=',', keep_default_na=False, na_values=[''], float_precision='round_trip')
+    return None
+
+# Outputs of every requested file format exist (the dataset is not checked)
+def outputs_exist(paths, output_formats):
+    return all(os.path.exists(paths[output_format]) for output_format in output_formats if output_format != 'dataset')
+#endregion
+
+#region Merge new years into existing results
+# Rows of the replaced years are dropped from the existing results, the new rows are added, sorted by region and year
+def merge_results(existing_df, new_df, replaced_years):
+
+    existing_df = existing_df[~existing_df['Year'].isin(replaced_years)].astype(new_df.dtypes.to_dict())
+    merged_df = pd.concat([existing_df, new_df], ignore_index=True)
+    return merged_df.sort_values([merged_df.columns[0], 'Year'], kind='stable').reset_index(drop=True)
+#endregion
+
+#region Aggregate only the new or changed years
+# The results of the new or changed years are merged into the existing NUTS and country outputs and the manifest is updated.
+# All years are aggregated if there is no manifest, the settings or weights changed, or an output cannot be read back
+def aggregate_incremental(forest_data, variables_to_include, cell_weights, levels, paths_by_level, country_paths, output_formats, path, run_settings):
+
+    checksums = year_checksums(forest_data[['Lon', 'Lat', 'Year'] + variables_to_include])
+    run_settings = {**run_settings, 'variables': list(variables_to_include), 'weights': cell_weights_checksum(cell_weights)}
+    years_to_aggregate, years_to_remove, full_run = changed_years(load_manifest(path), run_settings, checksums)
+
+    # Result families: (level, index in the (sums, averages) result, paths)
+    families = [(level, 1, paths_by_level[level]['nuts_avg']) for level in levels]
+    families += [(level, 0, paths_by_level[level]['nuts_sum']) for level in levels]
+    families += [('Country', 1, country_paths['country_avg']), ('Country', 0, country_paths['country_sum'])]
+
+    # Every output must be readable to merge into it, otherwise all years are aggregated again
+    existing = [None if full_run else load_existing_results(paths, output_formats) for _, _, paths in families]
+    up_to_date = all(existing_df is not None and outputs_exist(paths, output_formats) for (_, _, paths), existing_df in zip(families, existing))
+    if not years_to_aggregate and not years_to_remove and up_to_date:
+        print(f"6: No new or changed years in the input, the outputs are up to date ({path})")
+        return
+    if any(existing_df is None for existing_df in existing):
+        existing = [None] * len(families)
+        years_to_aggregate, years_to_remove = sorted(int(year) for year in checksums), []
+    replaced_years = years_to_aggregate + years_to_remove
+    print(f"6: Years aggregated: {years_to_aggregate}, years removed: {years_to_remove}")
+
+    # Weighted sums and averages of the new or changed years only
+    results = None
+    if years_to_aggregate:
+        forest_data_years = forest_data[forest_data['Year'].isin(years_to_aggregate)]
+        with instrumentation.stage('aggregate', rows_in=len(forest_data_years), file=path, engine='incremental', years=len(years_to_aggregate)) as record:
+            data_matrix = sparse_aggregation.build_data_matrix(forest_data_years, variables_to_include)
+            results = sparse_aggregation.calculate_weighted_sums_and_averages_by_level(cell_weights, data_matrix, levels)
+            record['rows_out'] = sum(len(weighted_df) for result in results.values() for weighted_df in result)
+
+    for (level, statistic, paths), existing_df in zip(families, existing):
+        new_df = results[level][statistic] if results is not None else existing_df.iloc[0:0]
+        if existing_df is not None:
+            new_df = merge_results(existing_df, new_df, replaced_years)
+        output_writer.save_results(new_df, paths, output_formats)
+
+    save_manifest(path, run_settings, checksums)
+#endregion
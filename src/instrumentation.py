@@ -0,0 +1,155 @@
+import os
+import sys
+import json
+import time
+import platform
+import threading
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Peak RSS is read with the resource module, which is not available on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Stage names, one selected stage can be profiled with cProfile or tracemalloc
+STAGES = ['load_shapefile', 'cell_weights', 'geometry', 'reprojection', 'overlay', 'weighting', 'parse', 'aggregate', 'output']
+PROFILE_METHODS = ['cprofile', 'tracemalloc']
+
+# Settings of this process, set with configure(). Stages are only recorded when enabled
+settings = {'enabled': False, 'profile_stage': None, 'profile_method': 'cprofile', 'profile_dir': '.', 'start': time.perf_counter()}
+
+# Stage records of this process. Background writer threads add records while the jobs take them
+records = []
+records_lock = threading.Lock()
+
+#region Configure
+# Called in the main process and in each worker process
+def configure(enabled=True, profile_stage=None, profile_method='cprofile', profile_dir='.'):
+
+    settings.update(enabled=enabled, profile_stage=profile_stage, profile_method=profile_method, profile_dir=profile_dir)
+#endregion
+
+#region Peak resident set size
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS. 'children' = finished worker processes
+def peak_rss_mb(children=False):
+
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    return usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+#endregion
+
+#region Record one stage
+# Usage: with instrumentation.stage('parse', file=path) as record: ... record['rows_out'] = len(forest_data)
+# Records wall time, peak RSS at the end of the stage, its increase during the stage and the row counts
+@contextmanager
+def stage(name, rows_in=None, **details):
+
+    record = {'stage': name, 'pid': os.getpid(), **details, 'rows_in': rows_in, 'rows_out': None}
+    if not settings['enabled']:
+        yield record
+        return
+
+    # Optional profiler of the selected stage
+    profiler = None
+    if settings['profile_stage'] == name:
+        if settings['profile_method'] == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            tracemalloc.start()
+
+    peak_before = peak_rss_mb()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = time.perf_counter() - start
+        record['peak_rss_mb'] = peak_rss_mb()
+        record['peak_rss_increase_mb'] = None if peak_before is None else record['peak_rss_mb'] - peak_before
+
+        if settings['profile_stage'] == name:
+            record['profile'] = stop_profiler(profiler, name)
+        with records_lock:
+            records.append(record)
+#endregion
+
+#region Stop the profiler of the selected stage
+# cProfile statistics are saved to <profile_dir>/profile_<stage>_<pid>_<n>.prof (open with pstats or snakeviz),
+# tracemalloc returns the peak traced memory and the 10 lines that allocated the most memory
+def stop_profiler(profiler, name):
+
+    if profiler is not None:
+        profiler.disable()
+        os.makedirs(settings['profile_dir'], exist_ok=True)
+        n_profiles = sum(1 for record in records if record['stage'] == name)
+        profile_path = os.path.join(settings['profile_dir'], f"profile_{name}_{os.getpid()}_{n_profiles}.prof")
+        profiler.dump_stats(profile_path)
+        return {'method': 'cprofile', 'path': profile_path}
+
+    snapshot = tracemalloc.take_snapshot()
+    peak_traced = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'method': 'tracemalloc',
+        'peak_traced_mb': peak_traced / (1024 * 1024),
+        'top_lines': [
+            {'line': str(statistic.traceback), 'size_mb': statistic.size / (1024 * 1024), 'count': statistic.count}
+            for statistic in snapshot.statistics('lineno')[:10]
+        ],
+    }
+#endregion
+
+#region Move records between processes
+# Worker processes return their records with the result, the main process adds them to its own records.
+# Forked workers inherit the records of the main process, only the records of this process are taken
+def take_records():
+
+    with records_lock:
+        taken = [record for record in records if record['pid'] == os.getpid()]
+        records[:] = [record for record in records if record['pid'] != os.getpid()]
+    return taken
+
+def add_records(worker_records):
+    with records_lock:
+        records.extend(worker_records)
+#endregion
+
+#region Write the JSON run report
+def write_report(report_path, argv=None):
+
+    # Totals per stage name over all files, levels and processes
+    summary = {}
+    for record in records:
+        stage_summary = summary.setdefault(record['stage'], {'count': 0, 'seconds': 0.0, 'rows_in': 0, 'rows_out': 0, 'max_peak_rss_mb': None})
+        stage_summary['count'] += 1
+        stage_summary['seconds'] += record['seconds']
+        stage_summary['rows_in'] += record['rows_in'] or 0
+        stage_summary['rows_out'] += record['rows_out'] or 0
+        if record['peak_rss_mb'] is not None:
+            stage_summary['max_peak_rss_mb'] = max(stage_summary['max_peak_rss_mb'] or 0, record['peak_rss_mb'])
+
+    report = {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'argv': sys.argv if argv is None else argv,
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'pid': os.getpid(),
+        'wall_seconds': time.perf_counter() - settings['start'],
+        'peak_rss_mb': peak_rss_mb(),
+        'peak_rss_workers_mb': peak_rss_mb(children=True),
+        'summary': summary,
+        'stages': records,
+    }
+
+    report_dir = os.path.dirname(report_path)
+    if report_dir:
+        os.makedirs(report_dir, exist_ok=True)
+    with open(report_path, "w") as file:
+        json.dump(report, file, indent=2, default=str)
+    print(f"** Run report saved to {report_path} **")
+#endregion
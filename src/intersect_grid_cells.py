@@ -0,0 +1,98 @@
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import shapely
+
+#region Intersect grid cells with regions using a spatial index
+# Returns (cell index, region index, intersected area) for every pair with a non-zero intersection, sorted by cell and region.
+# Both geometry arrays must be in the same projected CRS, the area is in the units of the CRS (m2 for EPSG:3035)
+def intersect_cells_strtree(cell_geometries, region_geometries):
+
+    cell_geometries = np.asarray(cell_geometries)
+    region_geometries = np.asarray(region_geometries)
+    tree = shapely.STRtree(region_geometries)
+
+    # Interior cells: cells that lie completely inside exactly one region get weight 1 without clipping
+    within_cell, within_region = tree.query(cell_geometries, predicate='within')
+    regions_per_cell = np.bincount(within_cell, minlength=len(cell_geometries))
+    interior = np.isin(within_cell, np.flatnonzero(regions_per_cell == 1))
+    interior_cell, interior_region = within_cell[interior], within_region[interior]
+
+    # Boundary cells: candidate pairs from the spatial index, exact clipping only for these
+    boundary_cells = np.flatnonzero(regions_per_cell != 1)
+    candidate_cell, candidate_region = tree.query(cell_geometries[boundary_cells], predicate='intersects')
+    candidate_cell = boundary_cells[candidate_cell]
+    candidate_area = shapely.area(shapely.intersection(cell_geometries[candidate_cell], region_geometries[candidate_region]))
+
+    # Pairs that only touch at the boundary have no intersected area
+    overlaps = candidate_area > 0
+
+    cell_index = np.concatenate([interior_cell, candidate_cell[overlaps]])
+    region_index = np.concatenate([interior_region, candidate_region[overlaps]])
+    intersection_area = np.concatenate([shapely.area(cell_geometries[interior_cell]), candidate_area[overlaps]])
+
+    # Deterministic order
+    order = np.lexsort((region_index, cell_index))
+    return cell_index[order], region_index[order], intersection_area[order]
+#endregion
+
+#region Partition grid cells into spatial tiles
+# Cells are split into strips along x and each strip along y, so every tile is compact and has about the same number of cells
+def partition_cells_into_tiles(cell_geometries, n_tiles):
+
+    bounds = shapely.bounds(cell_geometries)
+    center_x = (bounds[:, 0] + bounds[:, 2]) / 2
+    center_y = (bounds[:, 1] + bounds[:, 3]) / 2
+
+    n_strips = max(1, math.ceil(math.sqrt(n_tiles)))
+    tiles = []
+    for strip in np.array_split(np.argsort(center_x, kind='stable'), n_strips):
+        strip = strip[np.argsort(center_y[strip], kind='stable')]
+        tiles.extend(tile for tile in np.array_split(strip, n_strips) if len(tile))
+    return tiles
+#endregion
+
+#region Intersect one tile
+# Runs in a worker process, the indices of the tile are mapped back to the indices of the full arrays
+def intersect_tile(cell_index, cell_geometries, region_index, region_geometries):
+
+    tile_cell, tile_region, intersection_area = intersect_cells_strtree(cell_geometries, region_geometries)
+    return cell_index[tile_cell], region_index[tile_region], intersection_area
+#endregion
+
+#region Intersect grid cells with regions in parallel
+# Same result as intersect_cells_strtree. Each worker receives the grid cells of one tile and only the regions overlapping the tile
+def intersect_cells_parallel(cell_geometries, region_geometries, workers, tiles_per_worker=4):
+
+    cell_geometries = np.asarray(cell_geometries)
+    region_geometries = np.asarray(region_geometries)
+    tree = shapely.STRtree(region_geometries)
+
+    jobs = []
+    for tile in partition_cells_into_tiles(cell_geometries, workers * tiles_per_worker):
+        # Regions whose bounding box overlaps the bounding box of the tile
+        tile_bounds = shapely.bounds(cell_geometries[tile])
+        tile_box = shapely.box(tile_bounds[:, 0].min(), tile_bounds[:, 1].min(), tile_bounds[:, 2].max(), tile_bounds[:, 3].max())
+        tile_regions = np.sort(tree.query(tile_box))
+        jobs.append((tile, cell_geometries[tile], tile_regions, region_geometries[tile_regions]))
+
+    # No grid cells, no tiles
+    if not jobs:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+
+    # The workers are not forked, the calling process can have threads (e.g. the weights thread of --pipelined) holding locks
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        results = list(executor.map(intersect_tile, *zip(*jobs)))
+
+    # Merge the tiles in a deterministic order
+    cell_index = np.concatenate([result[0] for result in results])
+    region_index = np.concatenate([result[1] for result in results])
+    intersection_area = np.concatenate([result[2] for result in results])
+    order = np.lexsort((region_index, cell_index))
+
+    print(f"5: Grid cells intersected in {len(jobs)} tiles with {workers} worker processes")
+
+    return cell_index[order], region_index[order], intersection_area[order]
+#endregion
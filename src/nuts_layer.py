@@ -0,0 +1,116 @@
+import os
+import hashlib
+import numpy as np
+import geopandas as gpd
+import shapely
+
+# Helpers
+import weight_cache
+
+# Bump when the layout of the cached files changes
+LAYER_CACHE_VERSION = 3
+
+# Simplification tiers: tolerance in metres (EPSG:3035). Neighbouring NUTS-areas are simplified together
+# (coverage simplification), so no gaps or overlaps are created between them
+SIMPLIFICATION_TIERS = {'none': 0, 'fine': 250, 'medium': 1000, 'coarse': 5000}
+
+#region Simplify the NUTS-areas with a bounded area error
+# The tolerances are tried from the largest down until the area of every NUTS-area changes by at most max_area_error (relative).
+# Returns the geometries, the largest relative area error and the effective tolerance.
+# If the bound cannot be met, the geometries are kept as they are (tolerance 0)
+def simplify_with_area_bound(geometries, tolerances, max_area_error):
+
+    geometries = np.asarray(geometries)
+    areas = shapely.area(geometries)
+
+    for tolerance in sorted(tolerances, reverse=True):
+        simplified = shapely.coverage_simplify(geometries, tolerance)
+        area_error = np.max(np.abs(shapely.area(simplified) - areas) / areas) if len(areas) else 0.0
+        if area_error <= max_area_error:
+            return simplified, area_error, tolerance
+
+    return geometries, 0.0, 0
+#endregion
+
+#region Tolerances of a simplification tier
+# The tolerance of the tier and of every finer tier, each halved up to 4 times. A coarser tier tries all tolerances of the
+# finer tiers as well, so its effective tolerance is never smaller than that of a finer tier
+def tier_tolerances(simplify):
+
+    return sorted({tolerance / 2 ** halving for tolerance in SIMPLIFICATION_TIERS.values()
+                   if 0 < tolerance <= SIMPLIFICATION_TIERS[simplify] for halving in range(5)}, reverse=True)
+#endregion
+
+#region Cache path of a preprocessed NUTS layer
+# Key = shapefile contents, columns, CRS, simplification tier and area error bound
+def layer_cache_path(shapefile_path, columns, crs, simplify, max_area_error, cache_dir):
+
+    sha = hashlib.sha256()
+    sha.update(f"v{LAYER_CACHE_VERSION}_{','.join(columns)}_{crs}_{simplify}_{max_area_error!r}".encode())
+    sha.update(weight_cache.hash_shapefile(shapefile_path).encode())
+
+    base_name = os.path.splitext(os.path.basename(shapefile_path))[0]
+    return os.path.join(cache_dir, f"{base_name}_{simplify}_{sha.hexdigest()[:16]}.parquet")
+#endregion
+
+#region Bounding box of grid cells
+# (xmin, ymin, xmax, ymax) in 'crs' of the corners of all grid cells. The grid cell polygons have straight edges between
+# their projected corners, so they all lie inside the box
+def grid_cells_bbox(cells, degree, crs="EPSG:3035"):
+
+    lon = cells['Lon'].to_numpy(dtype=np.float64)
+    lat = cells['Lat'].to_numpy(dtype=np.float64)
+    corners = gpd.points_from_xy(np.concatenate([lon - degree / 2, lon + degree / 2, lon - degree / 2, lon + degree / 2]),
+                                 np.concatenate([lat - degree / 2, lat - degree / 2, lat + degree / 2, lat + degree / 2]), crs="EPSG:4326")
+    return tuple(gpd.GeoSeries(corners).to_crs(crs).total_bounds)
+#endregion
+
+#region Load a NUTS layer
+# Reads only the needed attribute columns, reprojects only if the shapefile is not in 'crs' and optionally simplifies.
+# With a cache_dir, the preprocessed layer is saved as GeoParquet with covering bbox columns and later runs read that copy.
+# bbox = (xmin, ymin, xmax, ymax) in 'crs': only the areas whose bounding box overlaps it are returned, from the cache
+# only their rows are read
+def load_nuts_layer(shapefile_path, columns=('NUTS_ID',), crs="EPSG:3035", simplify='none', max_area_error=0.01, cache_dir=None, bbox=None):
+
+    columns = list(columns)
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = layer_cache_path(shapefile_path, columns, crs, simplify, max_area_error, cache_dir)
+        if os.path.exists(cache_path):
+            nuts_areas = gpd.read_parquet(cache_path, columns=columns + ['geometry'], bbox=bbox)
+            print(f"2: NUTS-areas loaded from cache {cache_path}")
+            return nuts_areas
+
+    nuts_areas = gpd.read_file(shapefile_path, columns=columns)
+
+    # The NUTS shapefiles of this project are already in EPSG:3035
+    if nuts_areas.crs is None or not nuts_areas.crs.equals(crs):
+        nuts_areas = nuts_areas.to_crs(crs)
+
+    if SIMPLIFICATION_TIERS[simplify] > 0:
+        geometries, area_error, tolerance = simplify_with_area_bound(
+            nuts_areas.geometry.to_numpy(), tier_tolerances(simplify), max_area_error)
+        if tolerance == 0:
+            print(f"** Warning: the NUTS-areas could not be simplified ('{simplify}') within a relative area change of {max_area_error}, "
+                  f"they are used without simplification **")
+        else:
+            nuts_areas = nuts_areas.set_geometry(gpd.GeoSeries(geometries, index=nuts_areas.index, crs=nuts_areas.crs))
+            print(f"2: NUTS-areas simplified ('{simplify}') with a tolerance of {tolerance:g} m, largest relative area change {area_error:.2e}")
+
+    if cache_path is not None:
+        # Write to a temporary file first, so an interrupted run never leaves a half-written cache file
+        os.makedirs(cache_dir, exist_ok=True)
+        temporary_path = cache_path + f".{os.getpid()}.tmp"
+        nuts_areas.to_parquet(temporary_path, index=False, write_covering_bbox=True)
+        os.replace(temporary_path, cache_path)
+
+    # The whole layer is cached, the same bounding box overlap test as on the cached layer
+    if bbox is not None:
+        bounds = shapely.bounds(nuts_areas.geometry.to_numpy())
+        overlaps = (bounds[:, 0] <= bbox[2]) & (bounds[:, 2] >= bbox[0]) & (bounds[:, 1] <= bbox[3]) & (bounds[:, 3] >= bbox[1])
+        nuts_areas = nuts_areas[overlaps].reset_index(drop=True)
+
+    print(f"2: Shapefile '{shapefile_path}' loaded into 'nuts_areas'")
+
+    return nuts_areas
+#endregion
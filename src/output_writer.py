@@ -0,0 +1,165 @@
+import os
+import queue
+import threading
+import pandas as pd
+
+import instrumentation
+import weighted_statistics
+
+# Supported output formats. 'parquet' and 'feather' are typed columnar files, 'csv' and 'excel' are text exports and
+# 'dataset' adds the result to a Parquet dataset partitioned by level and statistic
+OUTPUT_FORMATS = ['parquet', 'feather', 'csv', 'excel', 'dataset']
+
+# Characters that would change meaning when the comma CSV is translated to the excel variant
+EXCEL_UNSAFE_CHARACTERS = [',', '.', ';', '"', '\n']
+
+# Result tables waiting in the background writer, the calculation waits when the queue is full
+WRITER_QUEUE_SIZE = 4
+
+#region Save results
+# 'paths' has one path per output format, only the formats in 'output_formats' are written
+def save_results(weighted_df, paths, output_formats):
+
+    with instrumentation.stage('output', rows_in=len(weighted_df), path=paths['csv'], formats=list(output_formats)) as record:
+        save_results_by_format(weighted_df, paths, output_formats)
+        record['rows_out'] = len(weighted_df)
+
+def save_results_by_format(weighted_df, paths, output_formats):
+
+    # Typed columnar files
+    if 'parquet' in output_formats:
+        weighted_df.to_parquet(paths['parquet'], index=False)
+        print(f"** Results saved to {paths['parquet']} **")
+    if 'feather' in output_formats:
+        weighted_df.reset_index(drop=True).to_feather(paths['feather'])
+        print(f"** Results saved to {paths['feather']} **")
+
+    # Text exports
+    if 'csv' in output_formats or 'excel' in output_formats:
+        save_csv_and_excel(weighted_df, paths['csv'] if 'csv' in output_formats else None,
+                           paths['excel'] if 'excel' in output_formats else None)
+
+    # Partitioned dataset of all result families, families without a dataset path are only written as files
+    if 'dataset' in output_formats and paths['dataset'] is not None:
+        save_to_dataset(weighted_df, *paths['dataset'])
+#endregion
+
+#region Background writer
+# Saves the results in a thread while the next results are calculated. save_results() queues a table and returns,
+# it waits only when 'queue_size' tables are waiting. An error in the thread is raised by the next save_results() or by close()
+class BackgroundWriter:
+
+    def __init__(self, queue_size=WRITER_QUEUE_SIZE):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            # After an error the remaining tables are not written, but the queue is emptied so the calculation does not wait
+            if self.error is None:
+                try:
+                    save_results(*item)
+                except Exception as error:
+                    self.error = error
+
+    def save_results(self, weighted_df, paths, output_formats):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((weighted_df, paths, output_formats))
+
+    # Waits until all queued tables are written
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+#endregion
+
+#region Save csv and excel variants
+# The floats are formatted to text only once: the excel variant (separator=";", decimal=",") is translated from the csv text
+def save_csv_and_excel(weighted_df, output_path, output_path_semicolon):
+
+    csv_text = weighted_df.to_csv(index=False)
+    if output_path is not None:
+        with open(output_path, "w", newline="") as file:
+            file.write(csv_text)
+        print(f"** Results saved to {output_path} **")
+
+    if output_path_semicolon is None:
+        return
+
+    # The translation is only safe if the text columns and the header have no separators, decimal points or quotes
+    text_values = [str(column) for column in weighted_df.columns]
+    for column in weighted_df.columns:
+        if not pd.api.types.is_numeric_dtype(weighted_df[column]):
+            text_values.extend(weighted_df[column].dropna().astype(str).unique())
+
+    if any(character in value for value in text_values for character in EXCEL_UNSAFE_CHARACTERS):
+        # Save the data to a semicolon-separated file with commas as decimal points (easily workable in excel)
+        weighted_df.to_csv(output_path_semicolon, index=False, sep=";", decimal=",")
+    else:
+        with open(output_path_semicolon, "w", newline="") as file:
+            file.write(csv_text.translate(str.maketrans({',': ';', '.': ','})))
+    print(f"** Results saved to {output_path_semicolon} **")
+#endregion
+
+#region Save to a partitioned dataset
+# The first column is the region column, renamed to 'region_id', and the 'weighted_avg_'/'weighted_sum_' prefixes are removed,
+# so that all families share one schema: dataset_dir/level=<level>/statistic=<statistic>/<basename>-0.parquet
+def save_to_dataset(weighted_df, dataset_dir, level, statistic, basename):
+
+    # A statistics table is split into one partition per statistic (statistic=var, std, min, max) with the same schema.
+    # Its sums and means are the 'sum' and 'avg' partitions, the covered area has no variable columns and is only in the files
+    if statistic == 'statistics':
+        key_columns = list(weighted_df.columns[:2])
+        for name in ['var', 'std', 'min', 'max']:
+            prefix = weighted_statistics.COLUMN_PREFIXES[name]
+            columns = [column for column in weighted_df.columns if column.startswith(prefix)]
+            if columns:
+                statistic_df = weighted_df[key_columns + columns].rename(columns=lambda column: column.removeprefix(prefix))
+                save_to_dataset(statistic_df, dataset_dir, level, name, basename)
+        return
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # The region IDs are strings in all partitions, also numeric IDs of other target layers (regrid.py)
+    dataset_df = weighted_df.rename(columns={weighted_df.columns[0]: 'region_id'})
+    dataset_df['region_id'] = dataset_df['region_id'].astype(str)
+    dataset_df.columns = [column.removeprefix('weighted_avg_').removeprefix('weighted_sum_') for column in dataset_df.columns]
+    dataset_df = dataset_df.assign(level=level, statistic=statistic)
+
+    # The same basename is overwritten when the same input is aggregated again
+    pq.write_to_dataset(
+        pa.Table.from_pandas(dataset_df, preserve_index=False),
+        dataset_dir,
+        partition_cols=['level', 'statistic'],
+        basename_template=basename + '-{i}.parquet',
+        existing_data_behavior='overwrite_or_ignore',
+    )
+    print(f"** Results saved to dataset {dataset_dir} (level={level}, statistic={statistic}) **")
+#endregion
+
+#region Create output directories
+def create_output_directories(output_dir, output_formats):
+
+    for output_format in output_formats:
+        if output_format != 'dataset':
+            os.makedirs(os.path.join(output_dir, output_format), exist_ok=True)
+#endregion
+
+#region Export csv and excel variants from a columnar file
+# For results saved only as Parquet or Feather, the text variants can be produced afterwards
+def export_csv_from_columnar(columnar_path, output_path, output_path_semicolon):
+
+    if columnar_path.endswith('.feather'):
+        weighted_df = pd.read_feather(columnar_path)
+    else:
+        weighted_df = pd.read_parquet(columnar_path)
+    save_csv_and_excel(weighted_df, output_path, output_path_semicolon)
+#endregion
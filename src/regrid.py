@@ -0,0 +1,230 @@
+# Imports
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+# Helpers
+import convert_and_load_data
+import grid_cell_geometry
+import grid_cell_weights
+import sparse_aggregation
+import cell_weighting
+import nuts_layer
+import output_writer
+import command_line
+import streaming_aggregation
+import weight_cache
+
+# Region ID column of the regular target grid, replaced by the Lon and Lat of the target cell centers in the outputs
+TARGET_CELL_COLUMN = 'target_cell'
+
+# Relative tolerance of the grid edges, so that edges shared by the source and target grid give no sliver pairs
+EDGE_TOLERANCE = 1e-9
+
+#region Cell weights for a regular lat/lon target grid
+# Exact and geometry-free: the target cells overlapping a grid cell follow from the index ranges of its edges, and the
+# overlapping area of two lat/lon rectangles is a band area on the GRS80 ellipsoid, b^2 * dlon / 2 * (q(lat2) - q(lat1)).
+# target_degree = cell size of the target grid, origin = (lon, lat) of the south-west corner of the target grid.
+# Returns the weights (columns of grid_cell_weights.calculate_cell_weights, the target cell index in TARGET_CELL_COLUMN)
+# and the number of target columns per row of the index
+def regular_grid_weights(cells, degree, target_degree, origin=(-180.0, -90.0)):
+
+    cells = cells[['Lon', 'Lat']].drop_duplicates().reset_index(drop=True)
+    lon = cells['Lon'].to_numpy(dtype=np.float64)
+    lat = cells['Lat'].to_numpy(dtype=np.float64)
+    west, east = lon - degree / 2, lon + degree / 2
+    south, north = np.clip(lat - degree / 2, -90, 90), np.clip(lat + degree / 2, -90, 90)
+
+    # Index ranges [first, last) of the target columns and rows overlapping each grid cell
+    first_column = np.floor((west - origin[0]) / target_degree + EDGE_TOLERANCE).astype(np.int64)
+    last_column = np.ceil((east - origin[0]) / target_degree - EDGE_TOLERANCE).astype(np.int64)
+    first_row = np.floor((south - origin[1]) / target_degree + EDGE_TOLERANCE).astype(np.int64)
+    last_row = np.ceil((north - origin[1]) / target_degree - EDGE_TOLERANCE).astype(np.int64)
+    if len(cells) and (first_column.min() < 0 or first_row.min() < 0):
+        raise ValueError(f"The target grid origin {origin} must be south-west of all grid cells.")
+
+    # One pair per (grid cell, overlapping target cell)
+    n_columns = last_column - first_column
+    pairs_per_cell = n_columns * (last_row - first_row)
+    cell_index = np.repeat(np.arange(len(cells)), pairs_per_cell)
+    pair_in_cell = np.arange(len(cell_index)) - np.repeat(np.cumsum(pairs_per_cell) - pairs_per_cell, pairs_per_cell)
+    column = first_column[cell_index] + pair_in_cell % n_columns[cell_index]
+    row = first_row[cell_index] + pair_in_cell // n_columns[cell_index]
+
+    # Overlap of the grid cell and the target cell in degrees
+    overlap_west = np.maximum(west[cell_index], origin[0] + column * target_degree)
+    overlap_east = np.minimum(east[cell_index], origin[0] + (column + 1) * target_degree)
+    overlap_south = np.maximum(south[cell_index], origin[1] + row * target_degree)
+    overlap_north = np.minimum(north[cell_index], origin[1] + (row + 1) * target_degree)
+
+    # Band areas on the ellipsoid
+    e2 = grid_cell_geometry.GRS80_FLATTENING * (2 - grid_cell_geometry.GRS80_FLATTENING)
+    b2 = grid_cell_geometry.GRS80_SEMI_MAJOR_AXIS ** 2 * (1 - e2)
+
+    def band_area_km2(west, east, south, north):
+        q = grid_cell_geometry.authalic_q
+        return b2 * np.radians(east - west) / 2 * (q(np.radians(north)) - q(np.radians(south))) / 1000000
+
+    area_km2 = band_area_km2(west, east, south, north)
+    intersection_area_km2 = band_area_km2(overlap_west, overlap_east, overlap_south, overlap_north)
+
+    # Target cells are numbered row by row, the number of columns covers the whole longitude range of the grid cells
+    columns_in_grid = int(last_column.max()) + 1 if len(cells) else 1
+    cell_weights = pd.DataFrame({
+        'Lon': lon[cell_index],
+        'Lat': lat[cell_index],
+        TARGET_CELL_COLUMN: row * columns_in_grid + column,
+        'area_km2': area_km2[cell_index],
+        'intersection_area_km2': intersection_area_km2,
+        'intersection_weight': intersection_area_km2 / area_km2[cell_index],
+    })
+
+    # Pairs that only touch at an edge have no overlap
+    cell_weights = cell_weights[cell_weights['intersection_weight'] > EDGE_TOLERANCE].reset_index(drop=True)
+
+    # Print progress
+    print(f"5: {len(cells)} grid cells mapped to a {target_degree}-degree grid by index overlap ({len(cell_weights)} pairs)")
+
+    return cell_weights, columns_in_grid
+#endregion
+
+#region Target cell centers
+# Replaces TARGET_CELL_COLUMN of a result table by the Lon and Lat of the target cell centers
+def target_cell_centers(weighted_df, target_degree, origin, columns_in_grid):
+
+    row, column = np.divmod(weighted_df[TARGET_CELL_COLUMN].to_numpy(), columns_in_grid)
+    centers = pd.DataFrame({'Lon': origin[0] + (column + 0.5) * target_degree, 'Lat': origin[1] + (row + 0.5) * target_degree})
+    return pd.concat([centers, weighted_df.drop(columns=TARGET_CELL_COLUMN)], axis=1)
+#endregion
+
+#region Dataset keys of the target cells
+# The dataset has one string region ID column for all results, so the target cells are keyed by '<Lon>_<Lat>' of their centers
+def target_cell_keys(weighted_df):
+
+    keys = weighted_df['Lon'].astype(str) + '_' + weighted_df['Lat'].astype(str)
+    return pd.concat([keys.rename(TARGET_CELL_COLUMN), weighted_df.drop(columns=['Lon', 'Lat'])], axis=1)
+#endregion
+
+#region Cell weights for target polygons
+# Any polygon layer (coarser grids, EEA reference grids, catchments, NUTS-areas) with a region ID column.
+# The layer is read with only the ID column and reprojected to the equal-area 'crs', with a GeoParquet copy in 'layer_cache_dir'.
+# Only the polygons around the grid cells are used, a global layer is not intersected with a regional grid
+def polygon_weights(cells, target_path, id_column, degree=0.5, crs="EPSG:3035", area_method='projected', overlay_method='strtree', overlay_workers=1,
+                    layer_cache_dir=None):
+
+    target_areas = nuts_layer.load_nuts_layer(target_path, columns=(id_column,), crs=crs, cache_dir=layer_cache_dir,
+                                              bbox=nuts_layer.grid_cells_bbox(cells, degree, crs))
+    if target_areas[id_column].duplicated().any():
+        print(f"** Some target polygons share an ID in column '{id_column}', they are aggregated together **")
+
+    return grid_cell_weights.calculate_cell_weights(cells, target_areas, degree=degree, area_method=area_method, overlay_method=overlay_method,
+                                                    overlay_workers=overlay_workers, id_column=id_column, crs=crs)
+#endregion
+
+#region Output paths
+# One average and one sum table per input file and target, e.g. regridded_weighted_averages_cpool_grid_2.0deg.csv
+def regrid_output_paths(output_dir, input_file_name, target_name):
+
+    return command_line.output_paths(output_dir, input_file_name, target_name, {
+        'regrid_avg': ('regridded_weighted_averages_', target_name, 'avg'),
+        'regrid_sum': ('regridded_weighted_sums_', target_name, 'sum'),
+    })
+#endregion
+
+#region Load cached cell weights for target polygons or calculate them
+# The target layer is only read when there is no valid cached weight table for the grid, layer, ID column and CRS
+def load_or_calculate_polygon_weights(cells, args):
+
+    cache_key = weight_cache.weights_cache_key(cells, args.degree, args.target, args.area_method, id_column=args.target_id_column, crs=args.target_crs)
+    cell_weights = weight_cache.load_cell_weights(cache_key, args.cache_dir)
+    if cell_weights is None:
+        cell_weights = polygon_weights(cells, args.target, args.target_id_column, args.degree, args.target_crs, args.area_method,
+                                       args.overlay_method, args.overlay_workers, args.layer_cache_dir)
+        weight_cache.save_cell_weights(cell_weights, cache_key, args.cache_dir, args.cache_max_size_mb, args.target_id_column)
+    return cell_weights
+#endregion
+
+#region Regrid one .out file
+# Weighted sums and averages per target region and year with the sparse matrix engine
+def regrid_file(forest_data_path_out, cell_weights, id_column, variable_dtype='float64'):
+
+    forest_data = convert_and_load_data.load_data_out(forest_data_path_out, variable_dtype)
+    variables_to_include = [column for column in forest_data.columns if column not in ['Lon', 'Lat', 'Year']]
+    data_matrix = sparse_aggregation.build_data_matrix(forest_data, variables_to_include)
+    return sparse_aggregation.calculate_weighted_sums_and_averages(cell_weights, data_matrix, id_column)
+#endregion
+
+#region Command line arguments
+def parse_arguments(argv=None):
+
+    parser = argparse.ArgumentParser(description="Conservative regridding of LPJ-GUESS variables to a coarser lat/lon grid or to any target polygons.")
+    command_line.add_input_arguments(parser)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--target', default=None, help="Target polygon file (shapefile, GeoPackage, GeoJSON, ...)")
+    target.add_argument('--target-grid', type=float, default=None, help="Cell size in degrees of a regular lat/lon target grid (index overlap, no polygons)")
+    parser.add_argument('--target-id-column', default='NUTS_ID', help="Region ID column of the target polygons (default: %(default)s)")
+    parser.add_argument('--target-origin', nargs=2, type=float, default=[-180.0, -90.0], metavar=('LON', 'LAT'),
+                        help="South-west corner of the regular target grid (default: %(default)s)")
+    parser.add_argument('--target-crs', default="EPSG:3035",
+                        help="Equal-area CRS of the intersected areas for target polygons (default: %(default)s)")
+    command_line.add_weight_arguments(parser, weighting='area')
+    command_line.add_output_arguments(parser)
+    parser.add_argument('--layer-cache-dir', default='../output/nuts_cache/',
+                        help="Cache directory for the preprocessed target polygons (GeoParquet) (default: %(default)s)")
+    return parser.parse_args(argv)
+#endregion
+
+def main(argv=None):
+    args = parse_arguments(argv)
+
+    input_files = command_line.find_input_files(args.inputs)
+    if not input_files or (args.target is not None and not os.path.exists(args.target)):
+        print("Input files not found. Check the file paths.")
+        return
+
+    output_writer.create_output_directories(args.output_dir, args.output_formats)
+    origin = tuple(args.target_origin)
+    if args.target_grid is not None:
+        id_column, target_name = TARGET_CELL_COLUMN, f"grid_{args.target_grid:g}deg"
+    else:
+        id_column, target_name = args.target_id_column, os.path.splitext(os.path.basename(args.target))[0]
+
+    # Per-cell land or forest fractions, loaded once for all files
+    cell_fractions = None
+    if args.cell_fractions is not None:
+        cell_fractions = cell_weighting.load_cell_fractions(args.cell_fractions, args.cell_fraction_column)
+
+    # The weights are calculated once per grid, files on the same grid share them. Target polygon weights are cached on disk,
+    # the regular grid weights follow from the cell coordinates alone
+    cell_weights_by_grid = {}
+    for forest_data_path_out in input_files:
+        cells = streaming_aggregation.read_grid_cells(forest_data_path_out, args.max_memory_mb)
+        grid = weight_cache.hash_grid_cells(cells)
+
+        if grid not in cell_weights_by_grid:
+            columns_in_grid = None
+            if args.target_grid is not None:
+                cell_weights, columns_in_grid = regular_grid_weights(cells, args.degree, args.target_grid, origin)
+            else:
+                cell_weights = load_or_calculate_polygon_weights(cells, args)
+            cell_weights = cell_weighting.apply_weighting(cell_weights, args.weighting, cell_fractions, args.sum_factor)
+            cell_weights_by_grid[grid] = cell_weights, columns_in_grid
+        cell_weights, columns_in_grid = cell_weights_by_grid[grid]
+
+        weighted_sum_df, weighted_avg_df = regrid_file(forest_data_path_out, cell_weights, id_column, 'float32' if args.float32 else 'float64')
+        if args.target_grid is not None:
+            weighted_sum_df = target_cell_centers(weighted_sum_df, args.target_grid, origin, columns_in_grid)
+            weighted_avg_df = target_cell_centers(weighted_avg_df, args.target_grid, origin, columns_in_grid)
+
+        paths = regrid_output_paths(args.output_dir, os.path.splitext(os.path.basename(forest_data_path_out))[0], target_name)
+        for family, weighted_df in [('regrid_avg', weighted_avg_df), ('regrid_sum', weighted_sum_df)]:
+            if args.target_grid is not None and 'dataset' in args.output_formats:
+                # The files keep the Lon and Lat columns, the dataset gets one key column
+                output_writer.save_results(weighted_df, paths[family], [output_format for output_format in args.output_formats if output_format != 'dataset'])
+                output_writer.save_results(target_cell_keys(weighted_df), paths[family], ['dataset'])
+            else:
+                output_writer.save_results(weighted_df, paths[family], args.output_formats)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+#region Build the data matrix
+# X = dense (cells x years*variables) array of the LPJ-GUESS values, P = (cells x years) presence of a data row.
+# With value_mask, M = (cells x years*variables) presence of a value (not missing), for statistics that must skip missing values
+def build_data_matrix(forest_data, variables_to_include, value_mask=False):
+
+    # Index the distinct grid cells and years
+    cell_index, cells = pd.MultiIndex.from_frame(forest_data[['Lon', 'Lat']]).factorize()
+    year_index, years = pd.factorize(forest_data['Year'], sort=True)
+    n_cells, n_years, n_variables = len(cells), len(years), len(variables_to_include)
+
+    # Non-numeric values count as missing values, which do not add to the sums (same as pandas sum)
+    values = forest_data[variables_to_include].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+    present = ~np.isnan(values)
+    values = np.nan_to_num(values, nan=0.0)
+
+    # Column of each (year, variable) pair in X
+    columns = year_index[:, None] * n_variables + np.arange(n_variables)[None, :]
+
+    X = np.zeros((n_cells, n_years * n_variables))
+    np.add.at(X, (np.repeat(cell_index, n_variables), columns.ravel()), values.ravel())
+
+    P = np.zeros((n_cells, n_years))
+    np.add.at(P, (cell_index, year_index), 1.0)
+
+    data_matrix = {
+        'cells': cells.to_frame(index=False, name=['Lon', 'Lat']),
+        'years': np.asarray(years),
+        'variables': list(variables_to_include),
+        'X': X,
+        'P': P,
+    }
+    if value_mask:
+        data_matrix['M'] = np.zeros(X.shape, dtype=bool)
+        np.logical_or.at(data_matrix['M'], (np.repeat(cell_index, n_variables), columns.ravel()), present.ravel())
+
+    print(f"6: Data matrix created for {n_cells} grid cells, {n_years} years and {n_variables} variables")
+    return data_matrix
+#endregion
+
+#region Build the sparse weight matrix
+# W = sparse (regions x cells) matrix of the intersection weights, or of another cell_weights column (e.g. intersection_area_km2).
+# 'code_length' groups the regions by the first characters of their codes, e.g. 2 = the countries of the NUTS_ID codes
+def build_weight_matrix(cell_weights, cells, group_column, value_column='intersection_weight', code_length=None):
+
+    groups = cell_weights[group_column]
+    if code_length is not None:
+        groups = groups.str[:code_length]
+    group_index, group_ids = pd.factorize(groups, sort=True)
+
+    # Grid cells in the weight table that are not in the data are dropped
+    cell_index = pd.MultiIndex.from_frame(cells).get_indexer(pd.MultiIndex.from_frame(cell_weights[['Lon', 'Lat']]))
+    in_data = cell_index >= 0
+
+    # Duplicate (region, cell) entries, e.g. several NUTS-areas of one country, are summed
+    W = sparse.csr_matrix(
+        (cell_weights[value_column].to_numpy(dtype=np.float64)[in_data], (group_index[in_data], cell_index[in_data])),
+        shape=(len(group_ids), len(cells)),
+    )
+    return W, np.asarray(group_ids)
+#endregion
+
+#region Calculate weighted totals per region
+# Sums = W @ X, weight totals = W @ P. These are additive, so they can be rolled up to coarser regions afterwards
+def calculate_weighted_totals(cell_weights, data_matrix, group_column='NUTS_ID', code_length=None):
+
+    W, group_ids = build_weight_matrix(cell_weights, data_matrix['cells'], group_column, code_length=code_length)
+    return weighted_totals_from_matrix(W, group_ids, data_matrix)
+#endregion
+
+#region Calculate weighted totals from a weight matrix
+# W = sparse (regions x cells) matrix whose columns are in the order of data_matrix['cells']
+def weighted_totals_from_matrix(W, group_ids, data_matrix):
+
+    # Number of data rows per (region, year), a group exists if at least one data row intersects the region in that year
+    W_pattern = W.copy()
+    W_pattern.data[:] = 1.0
+
+    return {
+        'group_ids': group_ids,
+        'years': data_matrix['years'],
+        'variables': data_matrix['variables'],
+        'sums': np.asarray(W @ data_matrix['X']),
+        'weights': np.asarray(W @ data_matrix['P']),
+        'rows': np.asarray(W_pattern @ data_matrix['P']),
+    }
+#endregion
+
+#region Roll weighted totals up the NUTS code hierarchy
+# NUTS codes are hierarchical: the first 2 characters are the country (NUTS-0), 3 = NUTS-1, 4 = NUTS-2 and 5 = NUTS-3.
+# Optional accumulators of weighted_statistics ('squares', 'value_weights', 'area', 'min', 'max') are rolled up as well
+def rollup_weighted_totals(weighted_totals, code_length):
+
+    # Prefix-based group index of each region
+    group_index, group_ids = pd.factorize(pd.Series(weighted_totals['group_ids']).str[:code_length], sort=True)
+    R = sparse.csr_matrix(
+        (np.ones(len(group_index)), (group_index, np.arange(len(group_index)))),
+        shape=(len(group_ids), len(group_index)),
+    )
+
+    rolled_up = {
+        'group_ids': np.asarray(group_ids),
+        'years': weighted_totals['years'],
+        'variables': weighted_totals['variables'],
+    }
+    for key in ['sums', 'weights', 'rows', 'squares', 'value_weights', 'area']:
+        if key in weighted_totals:
+            rolled_up[key] = np.asarray(R @ weighted_totals[key])
+
+    # Regions are sorted by code, so the regions of each coarser group are consecutive
+    group_starts = np.flatnonzero(np.diff(group_index, prepend=-1) != 0)
+    for key, reduce in [('min', np.fmin), ('max', np.fmax)]:
+        if key in weighted_totals:
+            rolled_up[key] = reduce.reduceat(weighted_totals[key], group_starts, axis=0) if len(group_starts) else weighted_totals[key]
+    return rolled_up
+#endregion
+
+#region Weighted sums and averages from the weighted totals
+def weighted_totals_to_frames(weighted_totals, group_column):
+
+    group_ids, years, variables = weighted_totals['group_ids'], weighted_totals['years'], weighted_totals['variables']
+    n_groups, n_years, n_variables = len(group_ids), len(years), len(variables)
+
+    # Keep only the (region, year) groups that have data
+    group_index, year_index = np.nonzero(weighted_totals['rows'])
+    weighted_sums = weighted_totals['sums'].reshape(n_groups, n_years, n_variables)[group_index, year_index]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weighted_avgs = weighted_sums / weighted_totals['weights'][group_index, year_index][:, None]
+
+    keys = pd.DataFrame({group_column: group_ids[group_index], 'Year': years[year_index]})
+    weighted_sum_df = pd.concat([keys, pd.DataFrame(weighted_sums, columns=[f'weighted_sum_{variable}' for variable in variables])], axis=1)
+    weighted_avg_df = pd.concat([keys, pd.DataFrame(weighted_avgs, columns=[f'weighted_avg_{variable}' for variable in variables])], axis=1)
+    return weighted_sum_df, weighted_avg_df
+#endregion
+
+#region Calculate weighted sums and averages in one pass
+# Sums = W @ X, averages = (W @ X) / (W @ P)
+def calculate_weighted_sums_and_averages(cell_weights, data_matrix, group_column, code_length=None):
+
+    weighted_sum_df, weighted_avg_df = weighted_totals_to_frames(calculate_weighted_totals(cell_weights, data_matrix, group_column, code_length), group_column)
+
+    # Print progress
+    print(f"7: Weighted sums and averages calculated per {group_column}")
+
+    return weighted_sum_df, weighted_avg_df
+#endregion
+
+#region Calculate weighted sums and averages for several NUTS levels in one pass
+# The totals are calculated once for the NUTS-areas of the overlay (e.g. NUTS-3) and rolled up to each level and to countries
+def calculate_weighted_sums_and_averages_by_level(cell_weights, data_matrix, levels):
+
+    nuts_totals = calculate_weighted_totals(cell_weights, data_matrix, 'NUTS_ID')
+    return weighted_totals_to_frames_by_level(nuts_totals, levels)
+#endregion
+
+#region Weighted sums and averages for several NUTS levels from the NUTS-area totals
+def weighted_totals_to_frames_by_level(nuts_totals, levels):
+
+    results = {}
+    for level in levels:
+        results[level] = weighted_totals_to_frames(rollup_weighted_totals(nuts_totals, 2 + level), 'NUTS_ID')
+        print(f"7: Weighted sums and averages calculated per NUTS-{level} area")
+
+    results['Country'] = weighted_totals_to_frames(rollup_weighted_totals(nuts_totals, 2), 'Country')
+    print("7: Weighted sums and averages calculated per country")
+
+    return results
+#endregion
@@ -0,0 +1,118 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+import convert_and_load_data
+
+# Rough memory use per parsed value and per expanded (row, region) entry, used to size the chunks.
+# The values of a chunk are also upcast to float64 once in the weighted sums
+BYTES_PER_PARSED_VALUE = 32
+BYTES_PER_WEIGHT_ENTRY = 48
+
+#region Chunk size for a memory ceiling
+# Number of .out rows per chunk so that parsing and weighting one chunk stays below the memory ceiling.
+# The fixed-size accumulators and the weights are subtracted from the ceiling first
+def chunk_rows_for_memory(n_columns, entries_per_row, fixed_bytes, max_memory_mb, min_chunk_rows=1000):
+
+    bytes_per_row = n_columns * (BYTES_PER_PARSED_VALUE + 8) + entries_per_row * BYTES_PER_WEIGHT_ENTRY
+    available_bytes = max_memory_mb * 1024 * 1024 - fixed_bytes
+    return max(min_chunk_rows, int(available_bytes // bytes_per_row))
+#endregion
+
+#region Distinct grid cells of an .out file in chunks
+# Only Lon and Lat are parsed, in chunks sized for the memory ceiling, and the duplicates are dropped per chunk.
+# The grid cells are in the order of their first row, as with drop_duplicates on the whole file
+def read_grid_cells(forest_data_path_out, max_memory_mb):
+
+    cells = pd.DataFrame({'Lon': pd.Series(dtype=np.float64), 'Lat': pd.Series(dtype=np.float64)})
+    chunk_rows = chunk_rows_for_memory(2, 0, 0, max_memory_mb)
+    for chunk in convert_and_load_data.read_out_file(forest_data_path_out, chunksize=chunk_rows, usecols=['Lon', 'Lat']):
+        cells = pd.concat([cells, chunk.drop_duplicates()], ignore_index=True).drop_duplicates(ignore_index=True)
+    return cells
+#endregion
+
+#region Calculate weighted totals per region from an .out file in chunks
+# Same result as sparse_aggregation.calculate_weighted_totals, but the .out file is never loaded as a whole.
+# Each chunk is weighted with the precomputed cell -> region weights and added to fixed-size per-(region, year) accumulators
+# 'input_rows' = number of rows read from the .out file
+def calculate_weighted_totals_streaming(forest_data_path_out, cell_weights, max_memory_mb, variable_dtype='float64'):
+
+    # Index the grid cells and regions of the weights, W = sparse (cells x regions) matrix
+    cells = pd.MultiIndex.from_frame(cell_weights[['Lon', 'Lat']].drop_duplicates())
+    cell_index = cells.get_indexer(pd.MultiIndex.from_frame(cell_weights[['Lon', 'Lat']]))
+    group_index, group_ids = pd.factorize(cell_weights['NUTS_ID'], sort=True)
+    W = sparse.csr_matrix(
+        (cell_weights['intersection_weight'].to_numpy(dtype=np.float64), (cell_index, group_index)),
+        shape=(len(cells), len(group_ids)),
+    )
+    n_groups = len(group_ids)
+
+    dtypes = convert_and_load_data.out_file_dtypes(forest_data_path_out, variable_dtype)
+    variables = [column for column in dtypes if column not in ['Lon', 'Lat', 'Year']]
+    n_variables = len(variables)
+
+    # Accumulators per year: sum of w*x per (region, variable), sum of w and number of rows per region
+    accumulators = {}
+
+    # Size the chunks from the memory ceiling, the accumulators are estimated for 250 years
+    fixed_bytes = W.data.nbytes * 3 + 250 * n_groups * (n_variables + 2) * 8
+    chunk_rows = chunk_rows_for_memory(len(dtypes), W.nnz / max(1, len(cells)), fixed_bytes, max_memory_mb)
+
+    n_rows = 0
+    for chunk in convert_and_load_data.read_out_file(forest_data_path_out, variable_dtype, chunksize=chunk_rows):
+        n_rows += len(chunk)
+
+        # Grid cells that do not intersect any region are skipped
+        row_cell = cells.get_indexer(pd.MultiIndex.from_frame(chunk[['Lon', 'Lat']]))
+        in_weights = row_cell >= 0
+        row_cell = row_cell[in_weights]
+        # The values keep the dtype of the parsed chunk (float32 with --float32)
+        values = np.nan_to_num(chunk[variables].to_numpy()[in_weights], nan=0.0)
+        year_index, chunk_years = pd.factorize(chunk['Year'].to_numpy()[in_weights])
+        n_chunk_years = len(chunk_years)
+
+        # Expand every row to its (region, weight) entries
+        entries_per_row = np.diff(W.indptr)[row_cell]
+        entry_row = np.repeat(np.arange(len(row_cell)), entries_per_row)
+        entry_offset = np.arange(len(entry_row)) - np.repeat(np.cumsum(entries_per_row) - entries_per_row, entries_per_row)
+        entry_position = W.indptr[row_cell][entry_row] + entry_offset
+        entry_weight = W.data[entry_position]
+
+        # Index of the (region, year) accumulator of each entry
+        target = W.indices[entry_position] * n_chunk_years + year_index[entry_row]
+        size = n_groups * n_chunk_years
+
+        chunk_weights = np.bincount(target, weights=entry_weight, minlength=size).reshape(n_groups, n_chunk_years)
+        chunk_rows_per_group = np.bincount(target, minlength=size).reshape(n_groups, n_chunk_years)
+
+        # Weighted sums = E @ values, E = sparse ((region, year) x rows) matrix of the entry weights. The sums are in float64
+        E = sparse.csr_matrix((entry_weight, (target, entry_row)), shape=(size, len(row_cell)))
+        chunk_sums = np.asarray(E @ values, dtype=np.float64).reshape(n_groups, n_chunk_years, n_variables)
+
+        # Add the chunk to the accumulators of its years
+        for chunk_year_index, year in enumerate(chunk_years):
+            if year not in accumulators:
+                accumulators[year] = [np.zeros((n_groups, n_variables)), np.zeros(n_groups), np.zeros(n_groups)]
+            accumulators[year][0] += chunk_sums[:, chunk_year_index]
+            accumulators[year][1] += chunk_weights[:, chunk_year_index]
+            accumulators[year][2] += chunk_rows_per_group[:, chunk_year_index]
+
+    # Files without any rows on the grid of the weights give empty totals
+    if not accumulators:
+        years = np.array([], dtype=np.int32)
+        return {'group_ids': np.asarray(group_ids), 'years': years, 'variables': variables, 'input_rows': n_rows,
+                'sums': np.zeros((n_groups, 0)), 'weights': np.zeros((n_groups, 0)), 'rows': np.zeros((n_groups, 0))}
+
+    years = np.array(sorted(accumulators))
+    print(f"6: {n_rows} rows of '{forest_data_path_out}' weighted in chunks of {chunk_rows} rows")
+
+    return {
+        'group_ids': np.asarray(group_ids),
+        'years': years,
+        'variables': variables,
+        'sums': np.stack([accumulators[year][0] for year in years], axis=1).reshape(n_groups, len(years) * n_variables),
+        'weights': np.stack([accumulators[year][1] for year in years], axis=1),
+        'rows': np.stack([accumulators[year][2] for year in years], axis=1),
+        'input_rows': n_rows,
+    }
+#endregion
@@ -0,0 +1,209 @@
+import hashlib
+from functools import lru_cache
+import os
+import re
+import numpy as np
+import pandas as pd
+
+# Bump when the layout of the cached files changes, old files are then rejected by the validation
+CACHE_VERSION = 2
+
+# Sidecar files that together make up a shapefile
+SHAPEFILE_EXTENSIONS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+
+#region Hash the shapefile contents
+# Cached per path, a batch run hashes each shapefile only once
+@lru_cache(maxsize=None)
+def hash_shapefile(shapefile_path):
+
+    # Hash every sidecar file of the shapefile, read in 1 MB blocks so large 01M files are not loaded into memory.
+    # Other vector files (e.g. GeoPackage, GeoJSON) are a single file
+    sha = hashlib.sha256()
+    base_path, file_extension = os.path.splitext(shapefile_path)
+    for extension in (SHAPEFILE_EXTENSIONS if file_extension.lower() == '.shp' else [file_extension]):
+        if not os.path.exists(base_path + extension):
+            continue
+        sha.update(extension.encode())
+        with open(base_path + extension, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                sha.update(block)
+    return sha.hexdigest()
+#endregion
+
+#region Hash the grid cells
+# Sort the coordinates so the order of the cells in the input file does not change the hash
+def grid_cell_bytes(cells):
+
+    coordinates = cells[['Lon', 'Lat']].sort_values(['Lon', 'Lat']).to_numpy(dtype=np.float64)
+    return np.ascontiguousarray(coordinates).tobytes()
+
+# Identifies a grid, e.g. for weights that do not depend on a shapefile
+def hash_grid_cells(cells):
+    return hashlib.sha256(grid_cell_bytes(cells)).hexdigest()
+#endregion
+
+#region Create the cache key
+# Key = hash of the distinct cell coordinates, the cell size, the shapefile contents, the NUTS level/scale, the simplification,
+# and the region ID column and the CRS of other target layers than the NUTS-areas
+def weights_cache_key(cells, degree, shapefile_path, area_method='projected', simplify='none', max_area_error=0.01, id_column='NUTS_ID', crs="EPSG:3035"):
+
+    sha = hashlib.sha256()
+    sha.update(f"v{CACHE_VERSION}_degree{degree!r}_{area_method}".encode())
+
+    # Simplified NUTS-areas give different weights, the keys of unsimplified runs are unchanged
+    if simplify != 'none':
+        sha.update(f"_simplify_{simplify}_{max_area_error!r}".encode())
+
+    # Other region ID columns or CRSs give different weights, the keys of NUTS runs are unchanged
+    if id_column != 'NUTS_ID' or crs != "EPSG:3035":
+        sha.update(f"_{id_column}_{crs}".encode())
+
+    sha.update(grid_cell_bytes(cells))
+
+    # NUTS level and scale, e.g. "01M_2021_3035_LEVL_2"
+    match = re.search(r'NUTS_RG_(\d+M)_(\d{4})_(\d{4})_LEVL_(\d)', os.path.basename(shapefile_path))
+    sha.update((match.group(0) if match else os.path.basename(shapefile_path)).encode())
+
+    sha.update(hash_shapefile(shapefile_path).encode())
+    return sha.hexdigest()
+#endregion
+
+#region Save a weight file
+# One layout for the weight cache and for WeightTable.save: per grid cell the coordinates and the area, per (grid cell, region)
+# pair the cell index, the region index and the weight. Written to a temporary file first, so an interrupted run never
+# leaves a half-written file
+def save_weights_file(path, lon, lat, area_km2, cell_index, region_codes, region_index, weight, region_column='NUTS_ID', cache_key=''):
+
+    # Numeric region IDs (e.g. HydroBASINS HYBAS_ID) keep their type, other codes are saved as text
+    region_codes = np.asarray(region_codes)
+    if not np.issubdtype(region_codes.dtype, np.number):
+        region_codes = region_codes.astype(str)
+
+    temporary_file = path + f".{os.getpid()}.tmp"
+    with open(temporary_file, "wb") as file:
+        np.savez_compressed(
+            file,
+            version=np.int32(CACHE_VERSION),
+            cache_key=np.array(cache_key),
+            region_column=np.array(region_column),
+            lon=np.asarray(lon, dtype=np.float64),
+            lat=np.asarray(lat, dtype=np.float64),
+            area_km2=np.asarray(area_km2, dtype=np.float64),
+            cell_index=np.asarray(cell_index, dtype=np.int32),
+            region_codes=region_codes,
+            region_index=np.asarray(region_index, dtype=np.int32),
+            weight=np.asarray(weight, dtype=np.float64),
+        )
+    os.replace(temporary_file, path)
+#endregion
+
+#region Load a weight file
+# Returns the arrays of the file. Raises an error if the file is not valid, or not for 'cache_key' (None = any key)
+def load_weights_file(path, cache_key=None):
+
+    with np.load(path, allow_pickle=False) as saved:
+        saved = {name: saved[name] for name in saved.files}
+    validate_cached_weights(saved, cache_key)
+    return saved
+#endregion
+
+#region Save cell weights to the cache
+# 'id_column' = region ID column of the cell weights, e.g. NUTS_ID
+def save_cell_weights(cell_weights, cache_key, cache_dir, max_cache_size_mb, id_column='NUTS_ID'):
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Store the weights as (cell index, region index, intersection_weight) plus per-cell coordinates and areas
+    cells = cell_weights[['Lon', 'Lat', 'area_km2']].drop_duplicates(['Lon', 'Lat']).reset_index(drop=True)
+    cell_index = pd.MultiIndex.from_frame(cells[['Lon', 'Lat']]).get_indexer(
+        pd.MultiIndex.from_frame(cell_weights[['Lon', 'Lat']]))
+    region_index, region_codes = pd.factorize(cell_weights[id_column])
+
+    cache_file = os.path.join(cache_dir, cache_key + '.npz')
+    save_weights_file(cache_file, cells['Lon'], cells['Lat'], cells['area_km2'], cell_index, region_codes, region_index,
+                      cell_weights['intersection_weight'], id_column, cache_key)
+    print(f"** Cell weights saved to cache {cache_file} **")
+
+    evict_cache(cache_dir, max_cache_size_mb)
+#endregion
+
+#region Load cell weights from the cache
+# Returns None if there is no valid cache file for the key
+def load_cell_weights(cache_key, cache_dir):
+
+    cache_file = os.path.join(cache_dir, cache_key + '.npz')
+    if not os.path.exists(cache_file):
+        return None
+
+    try:
+        cached = load_weights_file(cache_file, cache_key)
+    except Exception as e:
+        # Corrupt or outdated cache file, remove it and recompute the weights
+        print(f"Invalid weight cache file {cache_file} removed: {e}")
+        os.remove(cache_file)
+        return None
+
+    # Rebuild the compact weight table, one row per (grid cell, region) pair
+    cell_index = cached['cell_index']
+    area_km2 = cached['area_km2'][cell_index]
+    region_codes = cached['region_codes']
+    if region_codes.dtype.kind == 'U':
+        region_codes = region_codes.astype(object)
+    cell_weights = pd.DataFrame({
+        'Lon': cached['lon'][cell_index],
+        'Lat': cached['lat'][cell_index],
+        str(cached['region_column']): region_codes[cached['region_index']],
+        'area_km2': area_km2,
+        'intersection_area_km2': cached['weight'] * area_km2,
+        'intersection_weight': cached['weight'],
+    })
+
+    # Mark the file as recently used for the eviction
+    os.utime(cache_file)
+    print(f"5: Cell weights loaded from cache {cache_file}")
+    return cell_weights
+#endregion
+
+#region Validate cached weights
+def validate_cached_weights(cached, cache_key=None):
+
+    if int(cached['version']) != CACHE_VERSION:
+        raise ValueError(f"cache version {int(cached['version'])} does not match {CACHE_VERSION}")
+    if cache_key is not None and str(cached['cache_key']) != cache_key:
+        raise ValueError("cache key does not match the file name")
+
+    n_cells = len(cached['lon'])
+    if len(cached['lat']) != n_cells or len(cached['area_km2']) != n_cells:
+        raise ValueError("cell arrays have different lengths")
+
+    n_pairs = len(cached['cell_index'])
+    if len(cached['region_index']) != n_pairs or len(cached['weight']) != n_pairs:
+        raise ValueError("weight arrays have different lengths")
+    if n_pairs and (cached['cell_index'].min() < 0 or cached['cell_index'].max() >= n_cells):
+        raise ValueError("cell index out of range")
+    if n_pairs and (cached['region_index'].min() < 0 or cached['region_index'].max() >= len(cached['region_codes'])):
+        raise ValueError("region index out of range")
+
+    # Same check as for freshly calculated weights
+    tolerance = 1e-10
+    weights = cached['weight']
+    if not np.all((weights >= 0 - tolerance) & (weights <= 1 + tolerance)):
+        raise ValueError("some weights are outside the expected range of [0, 1]")
+#endregion
+
+#region Evict least recently used cache files
+def evict_cache(cache_dir, max_cache_size_mb):
+
+    cache_files = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith('.npz')]
+
+    # Oldest (least recently used) first
+    cache_files.sort(key=os.path.getmtime)
+    total_size = sum(os.path.getsize(path) for path in cache_files)
+
+    # Always keep the newest file, even if it alone is larger than the limit
+    while cache_files[:-1] and total_size > max_cache_size_mb * 1024 * 1024:
+        oldest = cache_files.pop(0)
+        total_size -= os.path.getsize(oldest)
+        os.remove(oldest)
+        print(f"** Weight cache file {oldest} evicted **")
+#endregion
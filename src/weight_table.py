@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Helpers, geopandas is only imported by WeightTable.from_shapefile
+import sparse_aggregation
+import weight_cache
+
+#region Weight table
+# Grid cell -> region weights of one overlay, as compact arrays:
+# - cell_lon, cell_lat (float64) and cell_area_km2 (float32): one value per grid cell
+# - cell_id, region_id (int32) and weight (float32): one value per (grid cell, region) pair
+# - region_codes: region code of each region_id, e.g. NUTS_ID
+# Can be applied to any LPJ-GUESS dataset on the same grid without importing geopandas
+class WeightTable:
+
+    def __init__(self, cell_lon, cell_lat, cell_area_km2, cell_id, region_id, weight, region_codes, region_column='NUTS_ID'):
+        self.cell_lon = np.asarray(cell_lon, dtype=np.float64)
+        self.cell_lat = np.asarray(cell_lat, dtype=np.float64)
+        self.cell_area_km2 = np.asarray(cell_area_km2, dtype=np.float32)
+        self.cell_id = np.asarray(cell_id, dtype=np.int32)
+        self.region_id = np.asarray(region_id, dtype=np.int32)
+        self.weight = np.asarray(weight, dtype=np.float32)
+        self.region_codes = np.asarray(region_codes, dtype=str)
+        self.region_column = region_column
+
+    def __len__(self):
+        return len(self.cell_id)
+
+    def __repr__(self):
+        return f"WeightTable({len(self.cell_lon)} cells, {len(self.region_codes)} regions, {len(self)} pairs)"
+
+    #region Create from the cell weights of the pipeline
+    # cell_weights: one row per (grid cell, region) pair with Lon, Lat, area_km2, intersection_weight and the region column
+    @classmethod
+    def from_cell_weights(cls, cell_weights, region_column='NUTS_ID'):
+
+        cell_id, cells = pd.MultiIndex.from_frame(cell_weights[['Lon', 'Lat']]).factorize()
+        region_id, region_codes = pd.factorize(cell_weights[region_column], sort=True)
+
+        # Area of each grid cell, from its first pair
+        first_pair = np.unique(cell_id, return_index=True)[1]
+        return cls(
+            cells.get_level_values(0), cells.get_level_values(1), cell_weights['area_km2'].to_numpy()[first_pair],
+            cell_id, region_id, cell_weights['intersection_weight'].to_numpy(), np.asarray(region_codes), region_column,
+        )
+    #endregion
+
+    #region Create from a grid and a NUTS shapefile (or other target polygons with id_column)
+    # grid: DataFrame with the Lon and Lat of the grid cell centers (e.g. an LPJ-GUESS .out file)
+    @classmethod
+    def from_shapefile(cls, grid, shapefile_path, degree=0.5, **kwargs):
+
+        import convert_and_load_data
+        import grid_cell_weights
+
+        nuts_areas = convert_and_load_data.load_data_shp(shapefile_path)
+        cell_weights = grid_cell_weights.calculate_cell_weights(grid, nuts_areas, degree=degree, **kwargs)
+        return cls.from_cell_weights(cell_weights, kwargs.get('id_column', 'NUTS_ID'))
+    #endregion
+
+    #region Convert to the cell weights of the pipeline
+    def to_cell_weights(self):
+
+        area_km2 = self.cell_area_km2[self.cell_id].astype(np.float64)
+        weight = self.weight.astype(np.float64)
+        return pd.DataFrame({
+            'Lon': self.cell_lon[self.cell_id],
+            'Lat': self.cell_lat[self.cell_id],
+            self.region_column: self.region_codes[self.region_id].astype(object),
+            'area_km2': area_km2,
+            'intersection_area_km2': weight * area_km2,
+            'intersection_weight': weight,
+        })
+    #endregion
+
+    #region Save and load
+    # Same file layout and validation as the weight cache (weight_cache.save_weights_file), a cache file can be loaded as well
+    def save(self, path):
+        weight_cache.save_weights_file(path, self.cell_lon, self.cell_lat, self.cell_area_km2, self.cell_id, self.region_codes,
+                                       self.region_id, self.weight, self.region_column)
+
+    @classmethod
+    def load(cls, path):
+
+        saved = weight_cache.load_weights_file(path)
+        return cls(saved['lon'], saved['lat'], saved['area_km2'], saved['cell_index'], saved['region_index'],
+                   saved['weight'], saved['region_codes'], str(saved['region_column']))
+    #endregion
+
+    #region Roll up to a coarser NUTS level
+    # NUTS codes are hierarchical, so the regions of a coarser level are the code prefixes: level 0 = 2 characters, ... 3 = 5
+    def rollup(self, level):
+
+        new_region_id, new_region_codes = pd.factorize(pd.Series(self.region_codes).str[:2 + level], sort=True)
+
+        # Pairs of the same grid cell in the same coarser region are summed
+        W = sparse.coo_matrix(
+            (self.weight.astype(np.float64), (self.cell_id, new_region_id[self.region_id])),
+            shape=(len(self.cell_lon), len(new_region_codes)),
+        ).tocsr()
+        W.sum_duplicates()
+        W = W.tocoo()
+
+        order = np.lexsort((W.col, W.row))
+        return WeightTable(
+            self.cell_lon, self.cell_lat, self.cell_area_km2, W.row[order], W.col[order], W.data[order],
+            np.asarray(new_region_codes), self.region_column,
+        )
+    #endregion
+
+    #region Sums and means of a dataset
+    # df: LPJ-GUESS data with Lon, Lat, Year and the variables. Returns (weighted sums, weighted means) per (region, Year)
+    def sum_and_mean(self, df, variables=None):
+
+        if variables is None:
+            variables = [column for column in df.columns if column not in ['Lon', 'Lat', 'Year']]
+        data_matrix = sparse_aggregation.build_data_matrix(df, variables)
+
+        # W = sparse (regions x cells) matrix, with the grid cells in the order of the data matrix.
+        # Grid cells of the weight table that are not in the data are dropped
+        data_cell = pd.MultiIndex.from_frame(data_matrix['cells']).get_indexer(
+            pd.MultiIndex.from_arrays([self.cell_lon, self.cell_lat]))[self.cell_id]
+        in_data = data_cell >= 0
+        W = sparse.csr_matrix(
+            (self.weight.astype(np.float64)[in_data], (self.region_id[in_data], data_cell[in_data])),
+            shape=(len(self.region_codes), len(data_matrix['cells'])),
+        )
+
+        weighted_totals = sparse_aggregation.weighted_totals_from_matrix(W, self.region_codes.astype(object), data_matrix)
+        return sparse_aggregation.weighted_totals_to_frames(weighted_totals, self.region_column)
+
+    def sum(self, df, variables=None):
+        return self.sum_and_mean(df, variables)[0]
+
+    def mean(self, df, variables=None):
+        return self.sum_and_mean(df, variables)[1]
+    #endregion
+#endregion
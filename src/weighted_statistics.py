@@ -0,0 +1,142 @@
+import numpy as np
+import pandas as pd
+
+# Helpers
+import sparse_aggregation
+
+# Statistics of the single-pass aggregator
+# - sum: weighted sum Σwx, mean: weighted average Σwx / Σw
+# - var, std: weighted (population) variance Σw(x - mean)² / Σw = Σwx² / Σw - mean², and its square root
+# - min, max: smallest and largest grid cell value in the region (grid cells with a non-zero weight and a value in the year)
+# var, std, min and max skip missing values: with the value mask of sparse_aggregation.build_data_matrix, Σw of var/std is
+# over the grid cells with a value, as for min/max. sum and mean count missing values as 0, as the weighted sums and averages
+# - area: covered area, sum of the intersected km2 of the grid cells with a data row in the year
+STATISTICS = ['sum', 'mean', 'var', 'std', 'min', 'max', 'area']
+
+# Output column prefix of each statistic, 'area' is one column per (region, year)
+COLUMN_PREFIXES = {'sum': 'weighted_sum_', 'mean': 'weighted_avg_', 'var': 'weighted_var_', 'std': 'weighted_std_', 'min': 'min_', 'max': 'max_'}
+
+# Relative rounding level of the single-pass variance (64 x float64 machine epsilon)
+VARIANCE_ROUNDING = 64 * np.finfo(np.float64).eps
+
+# Maximum size of the (intersection pairs x columns) block used for min/max
+MIN_MAX_BLOCK_VALUES = 8000000
+
+#region Calculate the accumulators of the statistics in one pass
+# Σw, Σwx and the row counts as in sparse_aggregation.calculate_weighted_totals, plus only the accumulators the statistics need:
+# Σwx² and Σw of the values for var/std, the intersected km2 for area and the per-region min/max of the grid cell values
+def calculate_statistic_totals(cell_weights, data_matrix, statistics, group_column='NUTS_ID', code_length=None):
+
+    W, group_ids = sparse_aggregation.build_weight_matrix(cell_weights, data_matrix['cells'], group_column, code_length=code_length)
+    totals = sparse_aggregation.weighted_totals_from_matrix(W, group_ids, data_matrix)
+    X, P = data_matrix['X'], data_matrix['P']
+
+    if 'var' in statistics or 'std' in statistics:
+        totals['squares'] = np.asarray(W @ (X * X))
+
+        # Σw of the grid cells with a value, per variable
+        if 'M' in data_matrix:
+            totals['value_weights'] = np.asarray(W @ data_matrix['M'].astype(np.float64))
+
+    if 'area' in statistics:
+        W_area, _ = sparse_aggregation.build_weight_matrix(cell_weights, data_matrix['cells'], group_column, 'intersection_area_km2', code_length)
+        totals['area'] = np.asarray(W_area @ P)
+
+    if 'min' in statistics or 'max' in statistics:
+        # Grid cells without a data row in a year and missing values are skipped, not counted as zeros.
+        # Without the value mask of build_data_matrix, only the data rows are known
+        if 'M' in data_matrix:
+            has_data = data_matrix['M']
+        else:
+            has_data = np.repeat(P > 0, len(data_matrix['variables']), axis=1)
+
+        # Values of the grid cells of each region, the regions are the row blocks of W (CSR)
+        W.sort_indices()
+        groups_with_cells = np.flatnonzero(np.diff(W.indptr) > 0)
+        minimum = np.full((len(group_ids), X.shape[1]), np.nan)
+        maximum = np.full((len(group_ids), X.shape[1]), np.nan)
+
+        # Column blocks keep the (pairs x columns) array small
+        block_columns = max(1, MIN_MAX_BLOCK_VALUES // max(1, W.nnz))
+        for start in range(0, X.shape[1], block_columns):
+            columns = slice(start, start + block_columns)
+            pair_values = np.where(has_data[W.indices, columns], X[W.indices, columns], np.nan)
+            if len(groups_with_cells):
+                minimum[groups_with_cells, columns] = np.fmin.reduceat(pair_values, W.indptr[groups_with_cells], axis=0)
+                maximum[groups_with_cells, columns] = np.fmax.reduceat(pair_values, W.indptr[groups_with_cells], axis=0)
+
+        # Only the requested ones are kept and rolled up
+        if 'min' in statistics:
+            totals['min'] = minimum
+        if 'max' in statistics:
+            totals['max'] = maximum
+
+    return totals
+#endregion
+
+#region Statistics from the accumulators
+# One row per (region, year) with data, the columns of each statistic in the order of 'statistics'
+def statistic_totals_to_frame(totals, group_column, statistics):
+
+    group_ids, years, variables = totals['group_ids'], totals['years'], totals['variables']
+    n_groups, n_years, n_variables = len(group_ids), len(years), len(variables)
+
+    # Keep only the (region, year) groups that have data
+    group_index, year_index = np.nonzero(totals['rows'])
+    weights = totals['weights'][group_index, year_index][:, None]
+
+    def values(key):
+        return totals[key].reshape(n_groups, n_years, n_variables)[group_index, year_index]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weighted_sums = values('sums')
+        weighted_avgs = weighted_sums / weights
+        if 'var' in statistics or 'std' in statistics:
+            # Σwx² / Σw - mean² loses the digits of the variance to rounding when the values are (nearly) equal,
+            # e.g. a region inside one grid cell. Variances at the rounding level of Σwx² / Σw are set to 0
+            # Missing values are skipped: Σw and the mean of the variance are over the grid cells with a value
+            value_weights = values('value_weights') if 'value_weights' in totals else weights
+            weighted_mean_squares = values('squares') / value_weights
+            weighted_vars = weighted_mean_squares - (weighted_sums / value_weights) ** 2
+            weighted_vars[weighted_vars <= VARIANCE_ROUNDING * weighted_mean_squares] = 0
+
+    columns = {group_column: group_ids[group_index], 'Year': years[year_index]}
+    for statistic in statistics:
+        if statistic == 'area':
+            columns['covered_area_km2'] = totals['area'][group_index, year_index]
+            continue
+        statistic_values = {
+            'sum': lambda: weighted_sums,
+            'mean': lambda: weighted_avgs,
+            'var': lambda: weighted_vars,
+            'std': lambda: np.sqrt(weighted_vars),
+            'min': lambda: values('min'),
+            'max': lambda: values('max'),
+        }[statistic]()
+        for variable_index, variable in enumerate(variables):
+            columns[COLUMN_PREFIXES[statistic] + variable] = statistic_values[:, variable_index]
+
+    return pd.DataFrame(columns)
+#endregion
+
+#region Calculate statistics for several NUTS levels and countries in one pass
+# The accumulators are calculated once for the NUTS-areas of the overlay and rolled up to each level and to countries
+def calculate_weighted_statistics_by_level(cell_weights, data_matrix, levels, statistics):
+
+    nuts_totals = calculate_statistic_totals(cell_weights, data_matrix, statistics)
+    return statistic_totals_to_frames_by_level(nuts_totals, levels, statistics)
+#endregion
+
+#region Statistics for several NUTS levels and countries from the NUTS-area accumulators
+def statistic_totals_to_frames_by_level(nuts_totals, levels, statistics):
+
+    results = {}
+    for level in levels:
+        results[level] = statistic_totals_to_frame(sparse_aggregation.rollup_weighted_totals(nuts_totals, 2 + level), 'NUTS_ID', statistics)
+    results['Country'] = statistic_totals_to_frame(sparse_aggregation.rollup_weighted_totals(nuts_totals, 2), 'Country', statistics)
+
+    # Print progress
+    print(f"7: Weighted statistics ({', '.join(statistics)}) calculated per NUTS-area and country")
+
+    return results
+#endregion